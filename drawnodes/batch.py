@@ -0,0 +1,421 @@
+#!/usr/bin/env python3
+# -*- mode: python -*-
+
+# The pipeline the sections of an input file go through - read, emit
+# (one after another or spread over a pool of worker processes), render
+# (openscad) and post (convert) - for the main()s of drawNodes,
+# drawNodesLabeled and drawProgression.
+
+import contextlib, io, itertools, os, signal, subprocess, sys, threading, time, traceback
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import redirect_stdout
+
+def job_count(value):
+    '''Number of worker processes for jobs option value value: 1 if
+    empty, all CPUs if 0.'''
+    n = parse_count('jobs', value, 1)
+    return n if n > 0 else os.cpu_count() or 1
+
+def parse_count(name, value, default=0):
+    '''Return the value of option name, value, a whole number of at
+    least 0, or default if value is empty.'''
+    if not value:
+        return default
+    try:
+        if int(value) >= 0:
+            return int(value)
+    except ValueError:
+        pass
+    raise ValueError(f'{name} should be a whole number, 0 or more: {value}')
+
+def parse_seconds(name, value, default):
+    '''Return the value of option name, value, a number of seconds more
+    than 0, or default if value is empty.'''
+    if not value:
+        return default
+    try:
+        if float(value) > 0:
+            return float(value)
+    except ValueError:
+        pass
+    raise ValueError(f'{name} should be a number of seconds, more than 0: {value}')
+
+class Stage:
+    '''One stage of a Pipeline: up to width jobs run at once (in
+    threads of its own, if threaded), with up to depth more waiting;
+    submit() blocks until there is room, so a stage that falls behind
+    holds back the one feeding it rather than letting work pile up.
+    Counts jobs, busy time (summed over jobs, including any wait to
+    pass a job on to the next stage), the most jobs in the stage at
+    once (running or waiting), and the time submitters were kept
+    waiting, for report().'''
+    def __init__(self, name, width=1, depth=0, threaded=False):
+        self.name, self.width, self.depth = name, width, depth
+        self.pool = ThreadPoolExecutor(width) if threaded else None
+        self.room, self.lock = threading.Semaphore(width + depth), threading.Lock()
+        self.jobs = self.inside = self.peak = 0
+        self.busy = self.blocked = 0.0
+    def submit(self, fn, *args):
+        # Run fn(*args) in the stage's threads, once there is room
+        t = time.monotonic()
+        self.room.acquire()
+        with self.lock:
+            self.blocked += time.monotonic() - t
+            self.inside += 1
+            self.peak = max(self.peak, self.inside)
+        return self.pool.submit(self._run, fn, *args)
+    def _run(self, fn, *args):
+        try:
+            with self.timing():
+                return fn(*args)
+        finally:
+            with self.lock:
+                self.inside -= 1
+            self.room.release()
+    @contextlib.contextmanager
+    def timing(self):
+        # Count a job, timing the with block as its run
+        t = time.monotonic()
+        try:
+            yield
+        finally:
+            self.count(time.monotonic() - t)
+    def count(self, busy):
+        # Count a job, run elsewhere, that was busy for busy seconds
+        with self.lock:
+            self.jobs += 1
+            self.busy += busy
+    def close(self):
+        if self.pool:
+            self.pool.shutdown()
+    def report(self, elapsed):
+        queue = f'{self.peak} of {self.width + self.depth}' if self.depth else '-'
+        use = self.busy / (self.width * elapsed) if elapsed else 0
+        return (f'{self.name:<8}{self.width:>6}{self.jobs:>6}{self.busy:>9.1f}s{use:>6.0%}'
+                f'{queue:>10}{self.blocked:>9.1f}s')
+
+class Pipeline:
+    '''The stages the sections of a run go through, each with its own
+    width (how many at once) and a bounded queue:
+
+    read    sections read from the input file, in the main process
+    emit    work(sec, options, sink) - parsing a section and writing its
+            .scad file - in jobs worker processes, at most 2*jobs
+            sections ahead of the earliest unfinished one
+    render  the first step of each render job submit()ted (openscad),
+            in renders threads; threads suffice, as the work is done in
+            subprocesses
+    post    the rest of a render job (convert), in posts threads
+
+    So while one section renders, the next is parsed and written, and
+    if renders fall behind, emit waits rather than queueing them all.
+    With renders 0 there are no render threads; sinks then render in
+    line, as part of emit.  costs, a costs.CostModel, if given, orders
+    and times out renders, and learns from them.'''
+    def __init__(self, jobs=1, renders=0, posts=0, costs=None):
+        self.jobs, self.start = jobs, time.monotonic()
+        self.stages = [Stage('read'), Stage('emit', jobs, jobs if jobs > 1 else 0)]
+        if renders:
+            posts = posts or renders
+            self.stages += [Stage('render', renders, 2*renders, True),
+                            Stage('post', posts, 2*posts, True)]
+        self.renders, self.costs = self.stages[2:], costs
+        self.waiting, self.active = [], set()   # Render jobs not started; names started
+        self.ready, self.order = threading.Condition(), itertools.count()
+        self.done, self.failed = 0, []
+        self.printing = threading.Lock()
+    def run(self, sections, work, options, sink, resume=False):
+        '''Call work(sec, options, sink) for each Section sec of iterable
+        sections, and return a list of the names of sections for which it
+        raised an exception.  Each such exception is reported on stderr,
+        and the other sections go on.  Each section that succeeds is
+        sink.finish()ed; with resume, those that sink says a run
+        finished() already, as they are now, are skipped.
+
+        If jobs is more than 1, the calls run in a pool of that many
+        worker processes (so work must be a module-level function).  Each
+        call's prints are collected and printed, and its outputs are given
+        to sink, in input order, so results are the same as a serial run's.'''
+        emit = self.stages[1]
+        failed, sections = [], self._reading(sections)
+        if resume:
+            sections = self._resuming(sections, options, sink)
+        if self.jobs <= 1:
+            for sec in sections:
+                try:
+                    with emit.timing():
+                        work(sec, options, sink)
+                except Exception:
+                    _report(sec.name, traceback.format_exc(), failed)
+                else:
+                    sink.finish(sec, options)
+            return failed
+        with ProcessPoolExecutor(self.jobs) as pool:
+            pending = deque()   # (sec, future) of sections in progress
+            for sec in sections:
+                # A later section of the same name overwrites an earlier
+                # one's files, so let the earlier one finish first
+                t = time.monotonic()
+                while len(pending) >= 2*self.jobs or any(s.name == sec.name for s, f in pending):
+                    self._finish(*pending.popleft(), options, sink, failed)
+                emit.blocked += time.monotonic() - t
+                pending.append((sec, pool.submit(_work, work, sec, options, sink.worker())))
+                emit.peak = max(emit.peak, len(pending))
+            while pending:
+                self._finish(*pending.popleft(), options, sink, failed)
+        return failed
+    def _resuming(self, sections, options, sink):
+        # Yield from sections those not finished already
+        for sec in sections:
+            if sink.finished(sec, options):
+                print(f'{sec.name} was finished already; skipping it')
+            else:
+                yield sec
+    def _reading(self, sections):
+        # Yield from sections, timing the reads
+        read, sections = self.stages[0], iter(sections)
+        while True:
+            t = time.monotonic()
+            sec = next(sections, None)
+            if sec is None:
+                return
+            read.count(time.monotonic() - t)
+            yield sec
+    def _finish(self, sec, future, options, sink, failed):
+        # Take in the results of Section sec's call
+        log, error, outputs, busy = future.result()
+        self.stages[1].count(busy)
+        sys.stdout.write(log)
+        sink.merge(outputs)
+        if error:
+            _report(sec.name, error, failed)
+        else:
+            sink.finish(sec, options)
+    def submit(self, name, job, inputs=(), then=None):
+        '''Run render job job in the render and post stages.  A job is a
+        call job(log, timeout) returning a generator, which prints its
+        messages to file log and allows openscad timeout seconds (None
+        for its default): its steps up to its first yield run in the
+        render stage, the rest in the post stage, and its value is True
+        if it succeeds.  Each job's messages are printed together when it
+        finishes, so jobs are reported in completion order; close() waits
+        for all of them and prints a summary.
+
+        Of the jobs waiting for the render stage, the one expected to
+        take longest, from the feature counts of its input files inputs,
+        starts first, so that a giant diagram doesn't start last and
+        hold up the end of the run.  Jobs for the same name run in
+        submission order, one at a time.  then, if given, is called with
+        the job's success, True or False, when it finishes.'''
+        counts = self.costs.counts(inputs) if self.costs else None
+        cost = self.costs.estimate(counts) if self.costs else 0
+        self.renders[0].submit(self._render)
+        with self.ready:
+            self.waiting.append((cost, next(self.order), name, job, counts, then))
+            self.ready.notify_all()
+    def _next(self):
+        # The waiting job to start next: the costliest of those first in
+        # line for their names, unless another job of that name is running
+        first = {}
+        for item in self.waiting:
+            first.setdefault(item[2], item)
+        ready = [item for name, item in first.items() if name not in self.active]
+        return max(ready, key=lambda item: (item[0], -item[1]), default=None)
+    def _render(self):
+        # In the render stage: run the next job up to its first yield,
+        # timing that for the cost model, then pass it on to the post stage
+        with self.ready:
+            while not (item := self._next()):
+                self.ready.wait()
+            self.waiting.remove(item)
+            self.active.add(item[2])
+        cost, order, name, job, counts, then = item
+        log, t = io.StringIO(), time.monotonic()
+        try:
+            steps = job(log, self.costs.timeout(counts) if self.costs else None)
+            next(steps)
+        except StopIteration as e:
+            return self._done(name, log, bool(e.value), then)
+        except Exception:
+            return self._fail(name, log, then)
+        if self.costs:
+            self.costs.record(counts, time.monotonic() - t, name)
+        self.renders[1].submit(self._post, name, steps, log, then)
+    def _post(self, name, steps, log, then):
+        # In the post stage: run the rest of the job
+        try:
+            ok = bool(run_steps(steps))
+        except Exception:
+            return self._fail(name, log, then)
+        self._done(name, log, ok, then)
+    def _fail(self, name, log, then):
+        log.write(f'Error rendering {name}:\n{traceback.format_exc()}')
+        self._done(name, log, False, then)
+    def _done(self, name, log, ok, then):
+        # Report the job, and let the next of its name start, even if
+        # then fails
+        try:
+            if then:
+                then(ok)
+        except Exception:
+            log.write(f'Error finishing {name}:\n{traceback.format_exc()}')
+        finally:
+            with self.printing:
+                sys.stdout.write(log.getvalue())
+                sys.stdout.flush()
+                if ok:
+                    self.done += 1
+                else:
+                    self.failed.append(name)
+            with self.ready:
+                self.active.discard(name)
+                self.ready.notify_all()
+    def close(self):
+        # Wait for render jobs, then print a summary of them
+        if not self.renders:
+            return
+        for stage in self.renders:
+            stage.close()
+        if self.costs:
+            self.costs.save()
+        n = self.done + len(self.failed)
+        print(f'Rendered {self.done} of {n} in {time.monotonic() - self.start:.1f}s'
+              + (f'; failed: {", ".join(self.failed)}' if self.failed else ''))
+    def report(self):
+        # Print each stage's width, jobs, busy time and share of the run's
+        # time, most jobs in it at once and its bound, and time spent
+        # waiting for room in it
+        elapsed = time.monotonic() - self.start
+        print(f'{"Stage":<8}{"Width":>6}{"Jobs":>6}{"Busy":>10}{"Use":>6}{"Peak":>10}{"Blocked":>10}')
+        for stage in self.stages:
+            print(stage.report(elapsed))
+
+def run_steps(steps):
+    '''Run generator steps (eg, of a render job) to the end, in line, and
+    return its value.'''
+    while True:
+        try:
+            next(steps)
+        except StopIteration as e:
+            return e.value
+
+def _work(work, sec, options, sink):
+    # In a worker process: call work, collecting its prints; return
+    # them, the traceback if it failed, the outputs it left in sink,
+    # and the time it took
+    log, error, t = io.StringIO(), None, time.monotonic()
+    with redirect_stdout(log):
+        try:
+            work(sec, options, sink)
+        except Exception:
+            error = traceback.format_exc()
+    return log.getvalue(), error, sink.handoff(), time.monotonic() - t
+
+def _report(name, error, failed):
+    sys.stdout.flush()
+    print(f'Error in section {name}:\n{error}', end='', file=sys.stderr)
+    failed.append(name)
+
+def run_main(options, work, directives=None, use_globals=True, file=None):
+    '''Do what the command-line options say, for the main()s of
+    drawNodes, drawNodesLabeled and drawProgression, given dict options
+    of option values and work(sec, options, sink), which writes one
+    Section's outputs.  The input file is options['file'] if given, else
+    file.  directives and use_globals are as for sections.read_sections()
+    (directives None for all of them).  Exits with a message, and status
+    1, if any section or render failed.'''
+    # Imported here, as sinks (which the others import) imports batch
+    try:
+        from .costs import CostModel
+        from .sections import DIRECTIVES, input_sections, section_names, parse_shard
+        from .sinks import open_sink, message_stream, merge_shards, MANIFEST
+        from .spool import enqueue, work as work_spool, LEASE
+    except ImportError:         # Run as a script rather than from the package
+        from costs import CostModel
+        from sections import DIRECTIVES, input_sections, section_names, parse_shard
+        from sinks import open_sink, message_stream, merge_shards, MANIFEST
+        from spool import enqueue, work as work_spool, LEASE
+    directives = tuple(DIRECTIVES) if directives is None else directives
+    if options['merge']:
+        # Combine the manifests of the archives that shard runs wrote,
+        # checking that together they cover the input file's sections,
+        # if one is given
+        names = section_names(options['file']) if options['file'] else None
+        problems = merge_shards(options['merge'].split(','), names, options['out'] or MANIFEST)
+        if problems:
+            sys.exit('\n'.join(problems))
+        return
+    options['file'] = options['file'] or file
+    try:
+        shard = parse_shard(options['shard'])
+        jobs, lease = job_count(options['jobs']), parse_seconds('lease', options['lease'], LEASE)
+        renders = parse_count('renders', options.get('renders'))    # Not in drawNodes
+        posts = parse_count('posts', options.get('posts'))
+    except ValueError as e:
+        sys.exit(str(e))
+    if options['enqueue']:
+        # Put the sections in a spool directory, for workers to take
+        try:
+            n = enqueue(options['enqueue'], options['file'], options['only'], shard)
+        except ValueError as e:
+            sys.exit(str(e))
+        print(f'Queued {n} sections in {options["enqueue"]}')
+        return
+    if options['work']:
+        # Take sections from a spool directory, one at a time, along with
+        # any other workers, until all are done
+        failed = work_spool(options['work'], work, options, bool(options['stable']), lease,
+                            directives, use_globals)
+        if failed:
+            sys.exit('Errors in sections: ' + ', '.join(failed))
+        return
+
+    # Sections go through a pipeline of stages: read; emit (in jobs
+    # worker processes); render and post (openscad and convert, in
+    # renders and posts threads, longest expected first, by the cost
+    # model kept in the output directory).  Outputs go to files, or to an
+    # archive (a tar stream on stdout for out=-, in which case messages
+    # go to stderr instead)
+    costs = CostModel() if renders else None
+    pipe = Pipeline(jobs, renders, posts, costs)
+    try:
+        sink = open_sink(options['out'], bool(options['stable']), pipe, shard,
+                         bool(options['resume'] or options['journal']))
+    except ValueError as e:
+        sys.exit(str(e))
+    with message_stream(options['out']):
+        # Read text for each diagram (or each one named by the only
+        # option), with its @ settings (global defaults from before the
+        # first diagram); write its outputs, in jobs worker processes.
+        # With renders, and outputs to files, read the diagrams costliest
+        # first, so a giant one late in the file doesn't render last
+        secs = input_sections(options['file'], options['only'], directives, use_globals, shard,
+                              costs.section_costs if costs and not options['out'] else None)
+        failed = pipe.run(secs, work, options, sink, bool(options['resume']))
+        sink.close()            # Waits for any renders
+        if options['jobs'] or options.get('renders') or options.get('posts'):
+            pipe.report()
+    # Sections that raised, and renders (in line or in the background) that failed
+    problems = ['Errors in sections: ' + ', '.join(failed)] if failed else []
+    if sink.failed:
+        problems.append('Failed renders: ' + ', '.join(sink.failed))
+    if problems:
+        sys.exit('\n'.join(problems))
+#==============================================================
+def run_command(cmd, timeout, cwd=None):
+    '''Run cmd as subprocess.run(cmd, capture_output=True, text=True,
+    timeout=timeout, cwd=cwd) would, but in a session of its own, so
+    that on timeout its whole process group is killed, not just cmd.'''
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+                          cwd=cwd, start_new_session=True) as p:
+        try:
+            out, err = p.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            if hasattr(os, 'killpg'):
+                os.killpg(p.pid, signal.SIGKILL)
+            else:
+                p.kill()
+            p.communicate()
+            raise
+    return subprocess.CompletedProcess(cmd, p.returncode, out, err)
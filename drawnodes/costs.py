@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# -*- mode: python -*-
+
+# Render-cost model for drawNodesLabeled and drawProgression.  How long
+# openscad takes to render a .scad file varies by orders of magnitude
+# between diagrams; it roughly tracks how many text halos, hull()ed
+# nodes, intersection()ed corners and so on the file draws.  CostModel
+# estimates it as a linear function of those counts, fitted to render
+# times recorded in earlier runs, which are kept in COSTS_FILE in the
+# output directory.  batch.Pipeline uses the estimates to start the
+# longest renders first, and to set each render's timeout.  The file
+# also keeps each diagram's latest feature counts, so that a run can
+# order its sections by expected cost before emitting any .scad file.
+
+import json, re, threading
+try:
+    from .sinks import diagram_of, write_atomic
+except ImportError:             # Run as a script rather than from the package
+    from sinks import diagram_of, write_atomic
+
+COSTS_FILE = '.drawnodes.costs'
+MAX_SAMPLES = 500               # Most recent render times kept
+MAX_DIAGRAMS = 10000            # Most recent diagrams' feature counts kept
+MIN_SAMPLES = 12                # Render times needed before fitting
+DEFAULT_TIMEOUT = 60            # Seconds allowed for an openscad render
+TIMEOUT_FACTOR = 5              # Timeout, as a multiple of the estimate
+
+# Calls in a .scad file that cost openscad time: feature -> pattern.
+# (A module's definition, 'module drawNode(...', doesn't count.)
+FEATURES = {
+    'halo':   r'drawCharHalo\w*\(',     # Four text()s each
+    'text':   r'drawChar(?!Halo)\w*\(',
+    'node':   r'drawNode\w*\(',         # hull()s of circles
+    'corner': r'drawCorner\(',          # intersection()s
+    'edge':   r'draw(?:V|H|Arrow|Diagonal\w*)\(',
+}
+_calls = re.compile('|'.join(f'(?<!module )(?P<{k}>{p})' for k, p in FEATURES.items()))
+
+def count_features(text):
+    '''Return a list of the counts of each of FEATURES in .scad text.'''
+    counts = dict.fromkeys(FEATURES, 0)
+    for m in _calls.finditer(text):
+        counts[m.lastgroup] += 1
+    return list(counts.values())
+
+class CostModel:
+    '''Estimates of render times, in seconds, from feature counts:
+    time = base + sum of weight*count, over FEATURES.  The weights are
+    fitted, by least squares, to the render times in file path (if
+    any) and those record()ed since; save() adds the latter to path.
+    Until there are MIN_SAMPLES times, estimates are just the counts'
+    total, which still ranks diagrams, and timeout() is the default.'''
+    def __init__(self, path=COSTS_FILE):
+        self.path, self.lock = path, threading.Lock()
+        (self.samples, self.diagrams), self.new, self.seen = self._load(), [], {}
+        self.weights = self._fit()
+    def _load(self):
+        # Render times, and diagram -> its feature counts, from path
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            if data.get('features') == list(FEATURES):
+                return ([s for s in data['samples'] if len(s) == len(FEATURES) + 1],
+                        {d: c for d, c in data.get('diagrams', {}).items() if len(c) == len(FEATURES)})
+        except (OSError, ValueError, AttributeError, KeyError, TypeError):
+            pass                # Missing, unreadable, or for other features
+        return [], {}
+    def counts(self, paths):
+        # Feature counts of the files named by paths, together
+        total = [0] * len(FEATURES)
+        for path in paths:
+            with open(path) as f:
+                total = [a + b for a, b in zip(total, count_features(f.read()))]
+        return total
+    def estimate(self, counts):
+        if self.weights is None:
+            return float(sum(counts))
+        base, *weights = self.weights
+        return base + sum(w * n for w, n in zip(weights, counts))
+    def timeout(self, counts):
+        '''Seconds to allow a render with feature counts counts: the
+        default, or a multiple of its estimate if that's longer.'''
+        if self.weights is None:
+            return DEFAULT_TIMEOUT
+        return max(DEFAULT_TIMEOUT, TIMEOUT_FACTOR * self.estimate(counts))
+    def record(self, counts, seconds, name=None):
+        # Record a render time, and the counts of output file name's diagram
+        with self.lock:
+            self.new.append(list(counts) + [round(seconds, 3)])
+            if name:
+                self.seen.setdefault(diagram_of(name), {})[name] = list(counts)
+    def section_costs(self, sizes):
+        '''Return a dict of the expected render cost of each section of
+        dict sizes, of section names to sizes in bytes: the estimate from
+        its diagram's counts in an earlier run, if any, else from its
+        size, scaled by the ratio of estimates to sizes of those known.'''
+        known = {name: self.estimate(self.diagrams[name]) for name in sizes if name in self.diagrams}
+        total = sum(sizes[name] for name in known)
+        scale = sum(known.values()) / total if total and sum(known.values()) > 0 else 1
+        return {name: known.get(name, size * scale) for name, size in sizes.items()}
+    def save(self):
+        '''Add the render times record()ed to file path, keeping the
+        MAX_SAMPLES most recent, and the counts of the diagrams rendered,
+        keeping the MAX_DIAGRAMS most recent; what other runs saved
+        meanwhile is kept too.  Failure to write (eg, a read-only
+        directory) is ignored.'''
+        with self.lock:
+            if not self.new:
+                return
+            samples, diagrams = self._load()
+            samples = (samples + self.new)[-MAX_SAMPLES:]
+            for diagram, jobs in self.seen.items():
+                diagrams.pop(diagram, None)     # Move it to the end, as most recent
+                diagrams[diagram] = [sum(c) for c in zip(*jobs.values())]
+            diagrams = dict(list(diagrams.items())[-MAX_DIAGRAMS:])
+            self.new, self.seen = [], {}
+        data = {'features': list(FEATURES), 'samples': samples, 'diagrams': diagrams}
+        try:
+            write_atomic(self.path, json.dumps(data).encode())
+        except OSError:
+            pass
+    def _fit(self):
+        # Least-squares [base, weights...] for the samples, or None if
+        # too few.  Negative weights (noise, or features that go along
+        # with others) are dropped and the rest refitted.
+        if len(self.samples) < MIN_SAMPLES:
+            return None
+        use = list(range(len(FEATURES)))
+        while True:
+            rows = [[1.0] + [s[i] for i in use] for s in self.samples]
+            w = _solve(rows, [s[-1] for s in self.samples])
+            bad = [i for i, x in zip(use, w[1:]) if x < 0]
+            if not bad:
+                break
+            use = [i for i in use if i not in bad]
+        weights = [0.0] * len(FEATURES)
+        for i, x in zip(use, w[1:]):
+            weights[i] = x
+        return [max(w[0], 0.0)] + weights
+
+def _solve(rows, y, ridge=1e-6):
+    # Least-squares x for rows.x = y, by the normal equations (with a
+    # little ridge, for features that never vary) and Gaussian elimination
+    n = len(rows[0])
+    a = [[sum(r[i] * r[j] for r in rows) + (ridge if i == j else 0) for j in range(n)]
+         + [sum(r[i] * v for r, v in zip(rows, y))] for i in range(n)]
+    for c in range(n):
+        p = max(range(c, n), key=lambda r: abs(a[r][c]))
+        a[c], a[p] = a[p], a[c]
+        if not a[c][c]:
+            continue
+        for r in range(n):
+            if r != c:
+                f = a[r][c] / a[c][c]
+                a[r] = [x - f * z for x, z in zip(a[r], a[c])]
+    return [a[i][n] / a[i][i] if a[i][i] else 0.0 for i in range(n)]
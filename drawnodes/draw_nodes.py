@@ -18,11 +18,20 @@
 # options defaulted.
 
 from sys import argv
-
-def heading(ofile):
+try:
+    from .grid import parse, traceLinks, CL
+    from .sinks import FileSink
+    from .batch import run_main
+except ImportError:             # Run as a script rather than from the package
+    from grid import parse, traceLinks, CL
+    from sinks import FileSink
+    from batch import run_main
+
+def heading(ofile, stable=False):
+    # If stable, leave out the time, so the file depends only on its input
     import datetime
-    dt = datetime.datetime.today().strftime('%Y-%m-%d  %H:%M:%S')
-    return f'// File {ofile}, generated {dt} by drawNodes' + '''
+    dt = '' if stable else datetime.datetime.today().strftime(' %Y-%m-%d  %H:%M:%S')
+    return f'// File {ofile}, generated{dt} by drawNodes' + '''
 // Number of sides for round things
 $fn=31;
 // Width as fraction of scale
@@ -67,75 +76,11 @@ def colorFix(h):  # Put # at front of color-value hex-digits string
     try:  x = int(h,16); return '#'+h
     except: return h
 #==============================================================
-class Junction:
-    cc = ['UR','LR','UL','LL','CL','XM','HM','HX']
-    def __init__(self, num, row, col, code):
-        self.num, self.code = num, code
-        self.row, self.col  = row, col
-        self.conn  = []         # No links yet to any neighbors
-    def setConn(self, c):
-        if c and c not in self.conn:
-            self.conn.append(c)
-            c.setConn(self)
-    def canon(p,q): return (min(p.col,q.col),max(p.col,q.col),min(p.row,q.row),max(p.row,q.row))
-    def __str__(self):
-        return f' {self.num:2} {self.row:2} {self.col:2} {self.cc[self.code]}'
-    def __repr__(self): return f'{str(self)} {[str(c) for c in self.conn]}'
-#==============================================================
-def process(idata, ofile, custom_colors=None, options=None):
-    UR, LR, UL, LL, CL, XM, HM, HX = range(8) # Set Corner & Mark Codes
-    def upChar(dx):   # Return neighbor char from previous line
-        if linn>0 and (0<= col+dx < len(idata[linn-1])):
-            return idata[linn-1][col+dx]
-        return '?'   # No character available?
-        
-    # Find locations of corners etc
-    corners, nodes, xlist, chars, linn, maxy = [], [], [], [], 0, len(idata)
-    for linn, l in enumerate(idata):
-        if not all(c in 'X#|_ /\\' for c in l):
-            chars.append((linn,l)); continue
-        # Now l only has suitable drawing characters
-        pc = None
-        for col, c in enumerate(l):
-            num = len(corners)
-            if c=='/':
-                if upChar(0) in '|#\\': # Need to check LR before UL
-                    corners.append(Junction(num, linn,col,LR)) # Lower Right
-                elif upChar(1)=='_':
-                    corners.append(Junction(num, linn,col,UL)) # Upper Left
-            elif c=='\\':
-               if upChar(0) in '|#/': # Need to check LL before UR
-                    corners.append(Junction(num, linn,col,LL)) # Lower Left
-               elif upChar(-1)=='_':
-                    corners.append(Junction(num, linn,col,UR)) # Upper Right
-            elif c=='#':
-                hcode = HX if pc=='#' else HM
-                corners.append(Junction(num, linn,col, hcode)) # Hashmark
-                nodes.append(corners[num])
-            elif c=='X':
-                corners.append(Junction(num, linn,col,XM)) # Xmark
-                xlist.append(corners[num])
-            pc = c
-        corners.append(Junction(0,0,0,0)) # Need extra node for xfar testing
-
-    def hhfind(cor):
-        for c in corners[1+cor.num:]:
-            #if (c.code==UR or c.code==LR) and c.row==cor.row: return corners[c.num]
-            if c.code==UR and c.row==cor.row: return corners[c.num]
-            if c.code==LR and c.row==cor.row: return corners[c.num]
-
-        return None   # not found??
-    def vvfind(cor):
-        for c in corners[1+cor.num:]:
-            if (c.code==LL or c.code==LR or c.code>CL) and c.col==cor.col:
-                return corners[c.num]
-        return None   # not found??
-        
-    for cor in corners:         # Connect up the pieces
-        if cor.code in (UL, LL):            
-            cor.setConn(hhfind(cor))    # Find & set end-column
-        if cor.code in (UL, UR, HM, HX):
-            cor.setConn(vvfind(cor))    # Find & set end-row
+def process(idata, ofile, custom_colors=None, options=None, grid=None, sink=None):
+    # Find and link corners etc, unless the caller has a grid of idata
+    # already (eg from an IncrementalParser)
+    g = grid or parse(idata, 'nodes')
+    corners, nodes, nodetab, xlist, chars, maxy = g.corners, g.nodes, g.nodetab, g.xlist, g.chars, g.maxy
 
     if 'x234etc' == ofile:
         for c in corners[:25]: print(repr(c))
@@ -161,31 +106,25 @@ def process(idata, ofile, custom_colors=None, options=None):
             fout.write (f'    drawH({base+1}, {maxy-c.row}, {abs(c.col-ecol)-1});\n')
 
     def colorTrace(c, d):
-        if c.canon(d) in drawn: return
-        code = c.code
-        # Draw c to d
-        if code<CL:
-            drawCorner(c)
-        drawH(c, d.col) # Draw to end-column, if ok
-        drawV(c, d.row) # Draw to end-row, if ok
-        drawn[c.canon(d)] = 1
-        if d.code < CL:
-            for e in d.conn:
-                colorTrace(d, e)
-
-    drawn = {}                  # Nothing yet drawn
-    with open(ofile+'.scad', 'w') as fout:
-
-        fout.write (heading(ofile)) # Write some drawing modules
+        # Draw each not-yet-drawn link of the trace, going on past corners
+        for c, d in traceLinks(c, d, drawn, lambda d: d.code < CL):
+            # Draw c to d
+            if c.code<CL:
+                drawCorner(c)
+            drawH(c, d.col) # Draw to end-column, if ok
+            drawV(c, d.row) # Draw to end-row, if ok
+
+    drawn = set()               # Edge keys of what's been drawn
+    # Write via sink, by default to a file in the current directory
+    sink = sink or FileSink()
+    with sink.open(ofile+'.scad') as fout:
+
+        fout.write (heading(ofile, sink.stable)) # Write some drawing modules
         
         if options['node']:     # Open nodes color block?
             fout.write (f'  color("{colorFix(options["node"])}") linear_extrude(height=1)' + ' {\n')
-            for b in nodes:
-                if b.code == HM:
-                    xfar = 1
-                    while corners[b.num+xfar].col==b.col+xfar and corners[b.num+xfar].code==HX:
-                        xfar += 1
-                    fout.write (f'    drawNode({b.col}, {maxy-b.row},{xfar});\n')
+            for n in nodetab:
+                fout.write (f'    drawNode({n.col}, {maxy-n.row},{n.xfar});\n')
             fout.write ('  }\n')    # Close drawNode's color block
 
         if options['text']:     # Open show-loci-numbers color block?
@@ -215,16 +154,9 @@ def process(idata, ofile, custom_colors=None, options=None):
 
         # First pass: collect ALL output column positions from all nodes
         all_output_columns = []
-        for b in nodes:
-            if b.code == HM:
-                # Find the extent of this node (HM + consecutive HX)
-                xfar = 1
-                while corners[b.num+xfar].col==b.col+xfar and corners[b.num+xfar].code==HX:
-                    xfar += 1
-                # Add only actual output columns (first and last of node extent)
-                all_output_columns.append(b.col)  # First output
-                if xfar > 1:
-                    all_output_columns.append(b.col + xfar - 1)  # Second output (rightmost)
+        for n in nodetab:
+            # Add only actual output columns (first and last of node extent)
+            all_output_columns.extend(n.out_cols)
 
         # Sort columns and create position -> color index mapping
         all_output_columns.sort()
@@ -262,40 +194,22 @@ def process(idata, ofile, custom_colors=None, options=None):
         # Close drawStuff module and invoke it
         fout.write ('}\ndrawStuff();\n')
 #======================================================================
+def do_section(sec, options, sink):
+    # Write the .scad file for input section sec, through sink (in a
+    # worker process, with the jobs option)
+    process(sec.lines, sec.name, sec.get('colors'), options, sink=sink)
+
 def main():
     # Set up default options to number the loci in red; suppress text;
     # paint node bodies in a pale blue; and by default read from t1-data.
-    options = { 'loci':'Red', 'text':'', 'node':'0000FF20', 'file':'validation/draw_nodes/basic_test_set.txt'}
-    arn, idata = 0, []
+    options = { 'loci':'Red', 'text':'', 'node':'0000FF20', 'file':'', 'only':'', 'out':'', 'stable':'', 'jobs':'', 'shard':'', 'merge':'', 'enqueue':'', 'work':'', 'lease':'', 'resume':'', 'journal':''}
+    arn = 0
     while (arn := arn+1) < len(argv):
         if '=' in argv[arn]:
             opt, val = argv[arn].split('=')
             options[opt] = val
         else: options['file'] = argv[arn] # Default case = file name
-    with open(options['file'], 'r') as fin:
-        while a := fin.readline():
-            # Read text for one diagram; send that text to process().
-            if a[0]=='=':           # Detect opening =
-                idata, ofile = [], a[1:].rstrip()
-                custom_colors = None
-                while a := fin.readline():   # Allow blank lines
-                    a = a.rstrip()  # Drop ending whitespace
-                    if a and a=='=':   # Detect closing =
-                        process(idata, ofile, custom_colors, options)
-                        break
-                    elif a.startswith('@colors='):
-                        # Parse @colors=Red,Blue,Green,#FF00FF,...
-                        try:
-                            color_string = a[8:].strip()
-                            if color_string:
-                                custom_colors = [c.strip() for c in color_string.split(',')]
-                            else:
-                                custom_colors = None
-                        except Exception as e:
-                            print(f"Warning: Invalid colors format: {a} - {e}")
-                            custom_colors = None
-                    else:
-                        idata.append(a)
+    run_main(options, do_section, ('colors',), False, file='validation/draw_nodes/basic_test_set.txt')
 
 if __name__ == "__main__":
     main()
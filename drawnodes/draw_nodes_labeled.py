@@ -18,13 +18,25 @@
 # options defaulted.
 
 from sys import argv
+import os
 from collections import deque
+from functools import partial
+from bisect import bisect_left
 import subprocess
-
-def heading(ofile):
+try:
+    from .grid import parse, traceLinks, CL, HM, HX
+    from .sinks import FileSink, temp_path
+    from .batch import run_main, run_command, run_steps
+except ImportError:             # Run as a script rather than from the package
+    from grid import parse, traceLinks, CL, HM, HX
+    from sinks import FileSink, temp_path
+    from batch import run_main, run_command, run_steps
+
+def heading(ofile, stable=False):
+    # If stable, leave out the time, so the file depends only on its input
     import datetime
-    dt = datetime.datetime.today().strftime('%Y-%m-%d  %H:%M:%S')
-    return f'// File {ofile}, generated {dt} by drawNodes' + '''
+    dt = '' if stable else datetime.datetime.today().strftime(' %Y-%m-%d  %H:%M:%S')
+    return f'// File {ofile}, generated{dt} by drawNodes' + '''
 /* [Label Colors] */
 // Color for edge labels
 label_color = "Black";
@@ -237,22 +249,38 @@ def calculate_camera_params(bbox, border=0, scale=10, target_imgsize=None):
 
         return (center_x, center_y, z_height), (img_width, img_height)
 
-def generate_png(ofile, imgsize, camera, border=0):
+def generate_png(ofile, imgsize, camera, border=0, dir='.', log=None, timeout=None):
     """Generate PNG from SCAD file using OpenSCAD CLI
 
     Args:
         border: Border size in pixels (default 0). Applied via ImageMagick after trimming.
+        dir: Directory holding the SCAD file, where the PNG is written (default '.')
+        log: File to print messages to (default: stdout)
+        timeout: Seconds to allow openscad (default: None - 60)
+
+    Returns:
+        True if the PNG was generated and processed without error
+    """
+    return run_steps(png_steps(ofile, imgsize, camera, border, dir, log, timeout))
+
+def png_steps(ofile, imgsize, camera, border=0, dir='.', log=None, timeout=None):
+    """generate_png() as a generator, for a batch.Pipeline: it yields
+    once, after running openscad and before convert, so that the two can
+    run in different stages.  Its value is generate_png()'s.
     """
     if not imgsize or not camera:
-        print(f"Warning: Missing metadata for {ofile}, skipping PNG generation")
+        print(f"Warning: Missing metadata for {ofile}, skipping PNG generation", file=log)
         return
 
+    # Work on a temporary file beside the PNG, renamed into place when done,
+    # so readers never see a PNG that openscad or convert is still writing
+    tmp = temp_path(f'{ofile}.png', '.png')
     w, h = imgsize
     x, y, z = camera
 
     cmd = [
         'openscad',
-        '-o', f'{ofile}.png',
+        '-o', tmp,
         '--imgsize', f'{w},{h}',
         '--camera', f'{x},{y},{z},{x},{y},0',
         '--projection=ortho',
@@ -262,10 +290,10 @@ def generate_png(ofile, imgsize, camera, border=0):
     ]
 
     try:
-        print(f"Generating {ofile}.png...")
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=60)
+        print(f"Generating {ofile}.png...", file=log)
+        result = run_command(cmd, timeout or 60, dir)
         if result.returncode == 0:
-            print(f"Successfully generated {ofile}.png")
+            print(f"Successfully generated {ofile}.png", file=log)
 
             # Make background transparent, trim excess, and add border using ImageMagick
             # Cornfield colorscheme uses RGB(255,255,229) as background
@@ -273,7 +301,7 @@ def generate_png(ofile, imgsize, camera, border=0):
             # Use -fuzz to handle anti-aliasing at edges
             convert_cmd = [
                 'convert',
-                f'{ofile}.png',
+                tmp,
                 '-fuzz', '5%',
                 '-transparent', 'rgb(255,255,229)',
                 '-transparent', 'rgb(202,198,198)',
@@ -282,40 +310,31 @@ def generate_png(ofile, imgsize, camera, border=0):
             # Add border if requested
             if border > 0:
                 convert_cmd.extend(['-bordercolor', 'none', '-border', str(int(border))])
-            convert_cmd.append(f'{ofile}.png')
+            convert_cmd.append(tmp)
 
-            print(f"Making background transparent and trimming...")
-            convert_result = subprocess.run(convert_cmd, capture_output=True, text=True, timeout=30)
+            yield               # On to the post stage, for convert
+            print(f"Making background transparent and trimming...", file=log)
+            convert_result = run_command(convert_cmd, 30, dir)
             if convert_result.returncode == 0:
                 if border > 0:
-                    print(f"Successfully created transparent background with {int(border)}px border")
+                    print(f"Successfully created transparent background with {int(border)}px border", file=log)
                 else:
-                    print(f"Successfully created transparent background (trimmed)")
+                    print(f"Successfully created transparent background (trimmed)", file=log)
             else:
-                print(f"Warning: Could not process image: {convert_result.stderr}")
+                print(f"Warning: Could not process image: {convert_result.stderr}", file=log)
+            os.replace(os.path.join(dir, tmp), os.path.join(dir, f'{ofile}.png'))
+            return convert_result.returncode == 0
         else:
-            print(f"Error generating {ofile}.png: {result.stderr}")
+            print(f"Error generating {ofile}.png: {result.stderr}", file=log)
     except FileNotFoundError:
-        print("Error: openscad command not found. Please install OpenSCAD.")
+        print("Error: openscad command not found. Please install OpenSCAD.", file=log)
     except subprocess.TimeoutExpired:
-        print(f"Error: OpenSCAD timed out generating {ofile}.png")
+        print(f"Error: OpenSCAD timed out generating {ofile}.png", file=log)
     except Exception as e:
-        print(f"Error generating {ofile}.png: {e}")
-#==============================================================
-class Junction:
-    cc = ['UR','LR','UL','LL','CL','XM','HM','HX']
-    def __init__(self, num, row, col, code):
-        self.num, self.code = num, code
-        self.row, self.col  = row, col
-        self.conn  = []         # No links yet to any neighbors
-    def setConn(self, c):
-        if c and c not in self.conn:
-            self.conn.append(c)
-            c.setConn(self)
-    def canon(p,q): return (min(p.col,q.col),max(p.col,q.col),min(p.row,q.row),max(p.row,q.row))
-    def __str__(self):
-        return f' {self.num:2} {self.row:2} {self.col:2} {self.cc[self.code]}'
-    def __repr__(self): return f'{str(self)} {[str(c) for c in self.conn]}'
+        print(f"Error generating {ofile}.png: {e}", file=log)
+    finally:
+        if os.path.exists(os.path.join(dir, tmp)):
+            os.remove(os.path.join(dir, tmp))
 #==============================================================
 class Edge:
     def __init__(self, label, start_row, start_col, end_row, end_col, source_node, dest_node, is_out2=False):
@@ -352,72 +371,13 @@ class Edge:
     def __repr__(self):
         return f'Edge({self.label}: ({self.start_row},{self.start_col}) -> ({self.end_row},{self.end_col}))'
 #==============================================================
-def process(idata, ofile, custom_colors=None, options=None):
-    UR, LR, UL, LL, CL, XM, HM, HX = range(8) # Set Corner & Mark Codes
-    def upChar(dx):   # Return neighbor char from previous line
-        if linn>0 and (0<= col+dx < len(idata[linn-1])):
-            return idata[linn-1][col+dx]
-        return '?'   # No character available?
-
-    # Find locations of corners etc
-    corners, nodes, xlist, chars, linn, maxy = [], [], [], [], 0, len(idata)
-    labels = {}  # Store (row, col) -> letter for edge labels
-
-    for linn, l in enumerate(idata):
-        # Extract labels (single letters) from each line
-        for col, c in enumerate(l):
-            if c.isalpha() and c.islower():
-                labels[(linn, col)] = c
-
-        # Check if line has any drawing characters for junction processing
-        has_drawing_chars = any(c in 'X#_ /\\' for c in l)
-        # Check if line has any non-drawing, non-space, non-label characters
-        has_other_chars = any(c not in 'X#|_ /\\' and not c.isspace() and not (c.isalpha() and c.islower()) for c in l)
-
-        if not has_drawing_chars or has_other_chars:
-            chars.append((linn,l)); continue
-        # Now l has drawing characters and possibly labels
-        pc = None
-        for col, c in enumerate(l):
-            num = len(corners)
-            if c=='/':
-                if upChar(0) in '|#\\': # Need to check LR before UL
-                    corners.append(Junction(num, linn,col,LR)) # Lower Right
-                elif upChar(1)=='_':
-                    corners.append(Junction(num, linn,col,UL)) # Upper Left
-            elif c=='\\':
-               if upChar(0) in '|#/': # Need to check LL before UR
-                    corners.append(Junction(num, linn,col,LL)) # Lower Left
-               elif upChar(-1)=='_':
-                    corners.append(Junction(num, linn,col,UR)) # Upper Right
-            elif c=='#':
-                hcode = HX if pc=='#' else HM
-                corners.append(Junction(num, linn,col, hcode)) # Hashmark
-                nodes.append(corners[num])
-            elif c=='X':
-                corners.append(Junction(num, linn,col,XM)) # Xmark
-                xlist.append(corners[num])
-            pc = c
-        corners.append(Junction(0,0,0,0)) # Need extra node for xfar testing
-
-    def hhfind(cor):
-        for c in corners[1+cor.num:]:
-            #if (c.code==UR or c.code==LR) and c.row==cor.row: return corners[c.num]
-            if c.code==UR and c.row==cor.row: return corners[c.num]
-            if c.code==LR and c.row==cor.row: return corners[c.num]
-
-        return None   # not found??
-    def vvfind(cor):
-        for c in corners[1+cor.num:]:
-            if (c.code==LL or c.code==LR or c.code>CL) and c.col==cor.col:
-                return corners[c.num]
-        return None   # not found??
-
-    for cor in corners:         # Connect up the pieces
-        if cor.code in (UL, LL):
-            cor.setConn(hhfind(cor))    # Find & set end-column
-        if cor.code in (UL, UR, HM, HX):
-            cor.setConn(vvfind(cor))    # Find & set end-row
+def process(idata, ofile, custom_colors=None, options=None, grid=None, sink=None):
+    # Find and link corners etc, unless the caller has a grid of idata
+    # already (eg from an IncrementalParser)
+    g = grid or parse(idata, 'labeled')
+    corners, nodes, nodetab, xlist, chars, maxy = g.corners, g.nodes, g.nodetab, g.xlist, g.chars, g.maxy
+    labels = g.labels  # Store row -> [(col, letter), ...] for edge labels
+    owner = g.owner    # Store HX junction number -> HM junction of its node
 
     if 'x234etc' == ofile:
         for c in corners[:25]: print(repr(c))
@@ -445,109 +405,118 @@ def process(idata, ofile, custom_colors=None, options=None):
             base = min(c.col, ecol)
             fout.write (f'    drawH({base+1}, {maxy-c.row}, {abs(c.col-ecol)-1});\n')
 
-    def find_destination(c, d, visited=None):
+    def find_destination(c, d):
         """Follow a trace path to find its destination node/X-mark and column.
         Similar to colorTrace but returns destination info instead of drawing."""
-        if visited is None:
-            visited = set()
-
-        canon = c.canon(d)
-        if canon in visited:
-            return None, None
-        visited.add(canon)
-
-        # If d is a destination (node or X mark), return it
-        if d.code >= CL:  # HM, HX, or XM
-            dest_col = c.col  # Use the column where trace actually arrives
-            dest_junction = d  # Default to d
-
-            # If it's an HX (node continuation), find the HM for node reference
-            if d.code == HX:
-                # Search backward to find the HM that starts this node
+        # Like colorTrace, go on through every connection of each corner
+        for c, d in traceLinks(c, d, set(), lambda d: d.code < CL):
+            # If d is a destination (node or X mark), return it
+            if d.code >= CL:  # HM, HX, or XM
+                dest_col = c.col  # Use the column where trace actually arrives
+                dest_junction = d  # Default to d
+
+                # If it's an HX (node continuation), use the HM that starts its node
                 # Keep dest_col as c.col (actual arrival), but return HM junction
-                for i in range(d.num - 1, -1, -1):
-                    if corners[i].row == d.row and corners[i].code == HM:
-                        dest_junction = corners[i]  # Use HM for node reference
-                        break
+                if d.code == HX:
+                    dest_junction = owner[d.num]  # Use HM for node reference
 
-            return dest_junction, dest_col
-
-        # If d is a corner, continue tracing through its connections
-        if d.code < CL:
-            for e in d.conn:
-                # colorTrace doesn't filter connections at corners, only at the starting node
-                dest, dest_col = find_destination(d, e, visited)
-                if dest:
-                    return dest, dest_col
+                return dest_junction, dest_col
 
         return None, None
 
-    def colorTrace(c, d):
-        if c.canon(d) in drawn: return
-        code = c.code
-
-        # If drawing to a node destination, shorten the line to end inside the arrow
-        # Arrow height is 1.25*wFrac, adjust to stop just inside arrow tip
-        arrow_adjust = 0.13 if d.code >= HM else 0
-
-        # Draw c to d
-        if code<CL:
-            drawCorner(c, arrow_adjust)
-        drawH(c, d.col) # Draw to end-column, if ok
-        drawV(c, d.row, arrow_adjust) # Draw to end-row, with optional arrow adjustment
-        drawn[c.canon(d)] = 1
-
-        # Draw arrowhead if d is a destination node (HM or HX, not XM)
-        if d.code >= HM:  # Node destination
-            # Arrow at bottom edge of node, centered on trace (col+0.5 due to wf offset)
-            fout.write(f'    drawArrow({c.col+0.5}, {maxy-d.row});\n')
-
+    # Label trace components once per diagram: union corners along their
+    # links, then record where each component meets node or X-mark
+    # junctions, as (corner, mark) links.  A trace from one output to one
+    # input meets exactly two marks, so its destination is whichever end
+    # it didn't start from; only traces that branch or merge, or that
+    # pass through a line-ending junction, need find_destination's walk.
+    parent = {}
+    def find(j):                # Root of j's component, halving the path to it
+        while (p := parent.get(j, j)) is not j:
+            parent[j] = j = parent.get(p, p)
+        return j
+    for c in corners:
+        if c.code < CL:
+            for e in c.conn:
+                if e.code < CL:
+                    a, b = find(c), find(e)
+                    if a is not b: parent[a] = b
+    trace_ends, tangled = {}, set()
+    for c in corners:
+        if c.code < CL:
+            root = find(c)
+            if corners[c.num] is not c: tangled.add(root)  # Line-ending junction
+            for e in c.conn:
+                if e.code >= CL:
+                    trace_ends.setdefault(root, []).append((c, e))
+
+    def trace_destination(c, d):
+        """Destination node/X-mark and arrival column of the trace that
+        leaves node junction c through its link to d."""
         if d.code < CL:
-            for e in d.conn:
-                colorTrace(d, e)
+            root = find(d)
+            ends = trace_ends[root]
+            if root not in tangled and len(ends) <= 2:
+                far = [(a, m) for a, m in ends if not (a is d and m is c)]
+                if not far: return None, None
+                if len(far) == 1:
+                    a, m = far[0]
+                    return (owner[m.num] if m.code == HX else m), a.col
+        return find_destination(c, d)
+
+    def colorTrace(c, d):
+        # Draw each not-yet-drawn link of the trace, going on past corners
+        for c, d in traceLinks(c, d, drawn, lambda d: d.code < CL):
+            # If drawing to a node destination, shorten the line to end inside the arrow
+            # Arrow height is 1.25*wFrac, adjust to stop just inside arrow tip
+            arrow_adjust = 0.13 if d.code >= HM else 0
+
+            # Draw c to d
+            if c.code<CL:
+                drawCorner(c, arrow_adjust)
+            drawH(c, d.col) # Draw to end-column, if ok
+            drawV(c, d.row, arrow_adjust) # Draw to end-row, with optional arrow adjustment
+
+            # Draw arrowhead if d is a destination node (HM or HX, not XM)
+            if d.code >= HM:  # Node destination
+                # Arrow at bottom edge of node, centered on trace (col+0.5 due to wf offset)
+                fout.write(f'    drawArrow({c.col+0.5}, {maxy-d.row});\n')
 
     # Find the row where node labels appear (row above nodes)
     label_row = None
     if nodes:
         label_row = min(n.row for n in nodes) - 1
+    row_labels = labels.get(label_row, [])  # Labels in that row, left to right
+    row_label_cols = [lc for lc, _ in row_labels]
 
     # Build edges with labels
     edges = []
     used_outputs = set()  # Track (node_row, out_col) for outputs that have edges
     all_output_labels = []  # Track all (node_row, out_col, label) tuples
 
-    for node in nodes:
-        if node.code != HM:
-            continue
-
-        # Find the extent of this node (HM + consecutive HX)
-        xfar = 1
-        while node.num+xfar < len(corners) and corners[node.num+xfar].col==node.col+xfar and corners[node.num+xfar].code==HX:
-            xfar += 1
+    for nd in nodetab:
+        node, xfar = nd.hm, nd.xfar
         node_end_col = node.col + xfar
 
         # Find all labels in the label row that are above this node
         output_labels = {}  # Map col -> label
-        if label_row is not None:
-            for (lr, lc), label in labels.items():
-                if lr == label_row and node.col <= lc < node_end_col:
-                    output_labels[lc] = label
-                    # Track all output labels for later unused output detection
-                    all_output_labels.append((node.row, lc, label))
+        k = bisect_left(row_label_cols, node.col)
+        for lc, label in row_labels[k:bisect_left(row_label_cols, node_end_col)]:
+            output_labels[lc] = label
+            # Track all output labels for later unused output detection
+            all_output_labels.append((node.row, lc, label))
 
         # Collect connections from ALL junctions within the node's extent (HM + HX)
         # Each HX junction can also have upward connections for additional outputs
         # Map column -> list of connections from that column
         conns_by_col = {}
-        for junction in corners:
-            # Check if this junction is part of this node (same row, within node extent)
-            if junction.row == node.row and node.col <= junction.col < node_end_col:
-                # Collect upward connections from this junction
-                for d in junction.conn:
-                    if d.num <= junction.num:  # Same filter as colorTrace
-                        if junction.col not in conns_by_col:
-                            conns_by_col[junction.col] = []
-                        conns_by_col[junction.col].append((junction, d))
+        for junction in nd.junctions:
+            # Collect upward connections from this junction
+            for d in junction.conn:
+                if d.num <= junction.num:  # Same filter as colorTrace
+                    if junction.col not in conns_by_col:
+                        conns_by_col[junction.col] = []
+                    conns_by_col[junction.col].append((junction, d))
 
         # Match labels with connections by column position
         for out_col, label in output_labels.items():
@@ -561,7 +530,7 @@ def process(idata, ofile, custom_colors=None, options=None):
                 start_junction, d = conns_by_col[out_col][0]
 
                 # Find destination for this connection
-                dest, dest_col = find_destination(start_junction, d)
+                dest, dest_col = trace_destination(start_junction, d)
 
             # Only create edges to nodes (not X marks - those are for inputs)
             if dest and dest.code >= HM:  # HM or HX (node junctions, not XM)
@@ -572,7 +541,7 @@ def process(idata, ofile, custom_colors=None, options=None):
                 end_col = dest_col
 
                 # Determine if this is out2 (rightmost column of node)
-                is_out2 = (out_col == node.col + xfar - 1)
+                is_out2 = (out_col == nd.out2_col)
 
                 edge = Edge(label, start_row, start_col, end_row, end_col, node, dest, is_out2)
                 edges.append(edge)
@@ -580,39 +549,29 @@ def process(idata, ofile, custom_colors=None, options=None):
                 # Mark this output as used
                 used_outputs.add((node.row, out_col))
 
-    drawn = {}                  # Nothing yet drawn
-    with open(ofile+'.scad', 'w') as fout:
+    drawn = set()               # Edge keys of what's been drawn
+    # Write via sink, by default to a file in the current directory
+    sink = sink or FileSink()
+    with sink.open(ofile+'.scad') as fout:
 
-        fout.write (heading(ofile)) # Write some drawing modules
+        fout.write (heading(ofile, sink.stable)) # Write some drawing modules
 
         # Draw node outlines in black (before filled nodes so outline shows)
         fout.write ('  color("Black") linear_extrude(height=1) {\n')
-        for b in nodes:
-            if b.code == HM:
-                xfar = 1
-                while corners[b.num+xfar].col==b.col+xfar and corners[b.num+xfar].code==HX:
-                    xfar += 1
-                fout.write (f'    drawNodeOutline({b.col}, {maxy-b.row},{xfar},wFrac);\n')
+        for n in nodetab:
+            fout.write (f'    drawNodeOutline({n.col}, {maxy-n.row},{n.xfar},wFrac);\n')
         fout.write ('  }\n')    # Close node outline color block
 
         if options['node']:     # Open nodes color block?
             fout.write (f'  color("{colorFix(options["node"])}") linear_extrude(height=1)' + ' {\n')
-            for b in nodes:
-                if b.code == HM:
-                    xfar = 1
-                    while corners[b.num+xfar].col==b.col+xfar and corners[b.num+xfar].code==HX:
-                        xfar += 1
-                    fout.write (f'    drawNode({b.col}, {maxy-b.row},{xfar});\n')
+            for n in nodetab:
+                fout.write (f'    drawNode({n.col}, {maxy-n.row},{n.xfar});\n')
             fout.write ('  }\n')    # Close drawNode's color block
 
         # Draw plus symbols (addition) in center of each node
         fout.write ('  color("Black") linear_extrude(height=1.1) {\n')
-        for b in nodes:
-            if b.code == HM:
-                xfar = 1
-                while corners[b.num+xfar].col==b.col+xfar and corners[b.num+xfar].code==HX:
-                    xfar += 1
-                fout.write (f'    drawXorSymbol({b.col}, {maxy-b.row},{xfar});\n')
+        for n in nodetab:
+            fout.write (f'    drawXorSymbol({n.col}, {maxy-n.row},{n.xfar});\n')
         fout.write ('  }\n')    # Close plus symbol color block
 
         if options['text']:     # Open show-loci-numbers color block?
@@ -659,13 +618,7 @@ def process(idata, ofile, custom_colors=None, options=None):
                           if (row, col) not in used_outputs]
 
         # Build a map to determine which outputs are out2 (rightmost column of each node)
-        node_rightmost_cols = {}  # node.row -> rightmost column
-        for node in nodes:
-            if node.code == HM:
-                xfar = 1
-                while node.num+xfar < len(corners) and corners[node.num+xfar].col==node.col+xfar and corners[node.num+xfar].code==HX:
-                    xfar += 1
-                node_rightmost_cols[node.row] = node.col + xfar - 1
+        node_rightmost_cols = {n.row: n.out2_col for n in nodetab}  # node.row -> rightmost column
 
         # Draw white halos for unused output labels (background layer)
         if unused_outputs:
@@ -725,31 +678,18 @@ def process(idata, ofile, custom_colors=None, options=None):
 
         # Draw complement circles on 2nd output of each node (drawn last so they appear on top)
         fout.write ('  color("Black") linear_extrude(height=1) {\n')
-        for node in nodes:
-            if node.code != HM:
-                continue
-            # Find the extent of this node (HM + consecutive HX)
-            xfar = 1
-            while node.num+xfar < len(corners) and corners[node.num+xfar].col==node.col+xfar and corners[node.num+xfar].code==HX:
-                xfar += 1
-            node_end_col = node.col + xfar
-
+        for n in nodetab:
             # Draw complement circle on 2nd output
             # The 2nd output is at the last column of the node extent
-            second_col = node_end_col - 1
-            fout.write(f'    drawComplement({second_col}, {maxy-node.row});\n')
+            fout.write(f'    drawComplement({n.out2_col}, {maxy-n.row});\n')
         fout.write ('  }\n')    # Close complement circles color block
 
         # Close drawStuff module and invoke it
         fout.write ('}\ndrawStuff();\n')
 
-    # Calculate bounding box from all corners
-    if corners:
-        min_col = min(c.col for c in corners if c.code != 0)
-        max_col = max(c.col for c in corners if c.code != 0)
-        min_row = min(c.row for c in corners if c.code != 0)
-        max_row = max(c.row for c in corners if c.code != 0)
-
+    # Bounding box from all corners
+    if g.bbox:
+        min_col, max_col, min_row, max_row = g.bbox
         # No fixed padding - use border parameter for padding control
         # This ensures symmetric borders when border > 0
         # Fixed padding was causing asymmetric borders due to center shift
@@ -774,6 +714,7 @@ COMMAND-LINE OPTIONS:
     file=FILENAME       Input file containing ASCII graphs
                         (default: validation/draw_nodes_labeled/labeled_test_set.txt)
                         Note: Bare filename also works (e.g., 'myfile')
+                        Use file=- to read from stdin
 
     node=COLOR          Color for node bodies
                         (default: 0000FF20 - pale blue with transparency)
@@ -787,6 +728,68 @@ COMMAND-LINE OPTIONS:
     png=VALUE           Enable PNG generation (any non-empty value)
                         (default: '' - disabled)
 
+    only=NAMES          Process only the diagrams with these names,
+                        comma-separated; glob patterns allowed
+                        (default: '' - all diagrams)
+
+    out=ARCHIVE         Write all output files into one archive, whose
+                        name must end in .tar or .zip, with a manifest;
+                        out=- writes a tar stream to stdout
+                        (default: '' - write separate files)
+
+    stable=VALUE        Leave the time out of .scad headers, and rewrite
+                        files only when they change; skip PNGs whose
+                        .scad and parameters are unchanged (any
+                        non-empty value) (default: '' - disabled)
+
+    jobs=N              Process diagrams in N worker processes; 0 for
+                        one per CPU (default: '' - one at a time)
+
+    renders=N           Run up to N PNG renders (openscad and convert)
+                        at once, in the background, longest expected
+                        first (by render times and diagrams' feature
+                        counts kept in .drawnodes.costs)
+                        (default: '' - one at a time, in line)
+
+    posts=N             Run up to N of those renders' convert steps at
+                        once (default: '' - as many as renders)
+
+    shard=I/N           Process just shard I of N, a share of the
+                        diagrams picked by name, balanced by size, for
+                        one of N runs that together do each once;
+                        without out, MANIFEST.json lists the files
+                        written (default: '' - all diagrams)
+
+    merge=A1,A2,...     Instead of drawing, combine the manifests of
+                        shard runs' archives or directories into one
+                        (written to out, default MANIFEST.json), and
+                        check that they cover the input file's
+                        diagrams just once (if an input file is given)
+
+    enqueue=DIR         Instead of drawing, put the diagrams in spool
+                        directory DIR, for workers to take
+
+    work=DIR            Take diagrams from spool directory DIR, one at
+                        a time, along with any other workers, until all
+                        are done; outputs go to DIR/out
+
+    lease=SECONDS       With work, how long a worker's claim on a
+                        diagram lasts if it stops renewing it, eg by
+                        dying (default: 60)
+
+    resume=VALUE        Skip diagrams that a run writing to the same
+                        directory finished, by its .drawnodes.journal,
+                        if their text, options and files are unchanged
+                        (any non-empty value) (default: '' - disabled)
+
+    journal=VALUE       Record the diagrams this run finishes in
+                        .drawnodes.journal, for a later resume (implied
+                        by resume) (any non-empty value) (default: '' -
+                        disabled)
+
+    With jobs, renders or posts, a table of each stage's width, busy
+    time and peak queue is printed at the end of the run.
+
 COLOR FORMATS:
     - Named colors:     Red, Green, Blue, Yellow, Black, etc.
     - Hex RGB:          FF0000 (red), 00FF00 (green)
@@ -835,148 +838,71 @@ INPUT FILE FORMAT:
 OUTPUT:
     - Always generates: diagram_name.scad (OpenSCAD file)
     - With png option:  diagram_name.png (transparent background)
+    - With out=ARCHIVE: those files as members of ARCHIVE, and
+                        MANIFEST.json listing them
 
 For more information, see README.rst
 """
     print(help_text)
 #======================================================================
+def do_section(sec, options, sink):
+    # Write the outputs for input section sec, through sink (in a worker
+    # process, with the jobs option)
+    imgsize, camera, border = sec.get('imgsize'), sec.get('camera'), sec.get('border')
+    # With png, a file sink locks the section's files while making
+    # them; an archive sink stages them on disk for openscad
+    with sink.staging(sec.name, options['png']) as stage:
+        # Process the SCAD file (file is fully written when this returns)
+        bbox = process(sec.lines, sec.name, sec.get('colors'), options, sink=stage)
+
+        # Generate PNG if requested
+        if options['png']:
+            # Use default border if not specified
+            final_border = border if border is not None else 0
+
+            # Calculate camera/imgsize from bounding box (always with 0 border for tight fit)
+            # Border is applied later via ImageMagick trim+border
+            # Pass imgsize if specified so z_height can be calculated to fit
+            calc_camera, calc_imgsize = calculate_camera_params(
+                bbox, border=0, target_imgsize=imgsize
+            )
+
+            # Use explicit camera if provided, otherwise use calculated
+            final_camera = camera if camera else calc_camera
+            final_imgsize = imgsize if imgsize else calc_imgsize
+
+            # Print calculated values for user reference
+            if border is None:
+                print(f"Calculated border: @border={final_border}")
+            if not camera:
+                print(f"Calculated camera: @camera={calc_camera[0]:.1f},{calc_camera[1]:.1f},{calc_camera[2]:.1f}")
+            if not imgsize:
+                print(f"Calculated imgsize: @imgsize={calc_imgsize[0]},{calc_imgsize[1]}")
+
+            # Make the PNG (in the background, with the renders option),
+            # unless stable and its .scad and parameters haven't changed
+            render = partial(png_steps, sec.name, final_imgsize, final_camera, final_border)
+            stage.make(sec.name + '.png', [sec.name + '.scad'],
+                       [final_imgsize, final_camera, final_border], render)
+#======================================================================
 def main():
     # Set up default options to suppress loci numbers; suppress text;
     # paint node bodies in a pale blue; and by default read from t1-data.
-    options = { 'loci':'', 'text':'', 'node':'0000FF20', 'file':'validation/draw_nodes_labeled/labeled_test_set.txt', 'png':''}
+    options = { 'loci':'', 'text':'', 'node':'0000FF20', 'file':'', 'png':'', 'only':'', 'out':'', 'stable':'', 'jobs':'', 'renders':'', 'posts':'', 'shard':'', 'merge':'', 'enqueue':'', 'work':'', 'lease':'', 'resume':'', 'journal':''}
 
     # Check for help flag first
     if '--help' in argv or '-h' in argv:
         print_help()
         exit(0)
 
-    arn, idata = 0, []
+    arn = 0
     while (arn := arn+1) < len(argv):
         if '=' in argv[arn]:
             opt, val = argv[arn].split('=')
             options[opt] = val
         else: options['file'] = argv[arn] # Default case = file name
 
-    # Parse global options (before first diagram)
-    global_options = {}
-    with open(options['file'], 'r') as fin:
-        # First pass: read global options (lines before first =)
-        while True:
-            pos = fin.tell()  # Save position before reading
-            a = fin.readline()
-            if not a:  # EOF
-                break
-            if a[0] == '=':
-                # Found first diagram, go back to this line
-                fin.seek(pos)
-                break
-            # Parse global options
-            a = a.rstrip()
-            if a.startswith('@imgsize='):
-                parts = a[9:].split(',')
-                if len(parts) == 2:
-                    try:
-                        global_options['imgsize'] = (int(parts[0]), int(parts[1]))
-                    except ValueError:
-                        print(f"Warning: Invalid global imgsize format: {a}")
-            elif a.startswith('@camera='):
-                parts = a[8:].split(',')
-                if len(parts) == 3:
-                    try:
-                        global_options['camera'] = (float(parts[0]), float(parts[1]), float(parts[2]))
-                    except ValueError:
-                        print(f"Warning: Invalid global camera format: {a}")
-            elif a.startswith('@border='):
-                try:
-                    global_options['border'] = float(a[8:])
-                except ValueError:
-                    print(f"Warning: Invalid global border format: {a}")
-            elif a.startswith('@colors='):
-                try:
-                    color_string = a[8:].strip()
-                    if color_string:
-                        global_options['colors'] = [c.strip() for c in color_string.split(',')]
-                except Exception as e:
-                    print(f"Warning: Invalid global colors format: {a} - {e}")
-
-        # Second pass: process diagrams
-        while a := fin.readline():
-            # Read text for one diagram; send that text to process().
-            if a[0]=='=':           # Detect opening =
-                idata, ofile = [], a[1:].rstrip()
-                # Initialize with global defaults
-                imgsize = global_options.get('imgsize', None)
-                camera = global_options.get('camera', None)
-                border = global_options.get('border', None)
-                custom_colors = global_options.get('colors', None)
-
-                while a := fin.readline():   # Allow blank lines
-                    a = a.rstrip()  # Drop ending whitespace
-                    if a and a=='=':   # Detect closing =
-                        # Process the SCAD file (file is fully written when this returns)
-                        bbox = process(idata, ofile, custom_colors, options)
-
-                        # Generate PNG if requested
-                        if options['png']:
-                            # Use default border if not specified
-                            final_border = border if border is not None else 0
-
-                            # Calculate camera/imgsize from bounding box (always with 0 border for tight fit)
-                            # Border is applied later via ImageMagick trim+border
-                            # Pass imgsize if specified so z_height can be calculated to fit
-                            calc_camera, calc_imgsize = calculate_camera_params(
-                                bbox, border=0, target_imgsize=imgsize
-                            )
-
-                            # Use explicit camera if provided, otherwise use calculated
-                            final_camera = camera if camera else calc_camera
-                            final_imgsize = imgsize if imgsize else calc_imgsize
-
-                            # Print calculated values for user reference
-                            if border is None:
-                                print(f"Calculated border: @border={final_border}")
-                            if not camera:
-                                print(f"Calculated camera: @camera={calc_camera[0]:.1f},{calc_camera[1]:.1f},{calc_camera[2]:.1f}")
-                            if not imgsize:
-                                print(f"Calculated imgsize: @imgsize={calc_imgsize[0]},{calc_imgsize[1]}")
-
-                            generate_png(ofile, final_imgsize, final_camera, final_border)
-                        break
-                    elif a.startswith('@imgsize='):
-                        # Parse @imgsize=800,250
-                        parts = a[9:].split(',')
-                        if len(parts) == 2:
-                            try:
-                                imgsize = (int(parts[0]), int(parts[1]))
-                            except ValueError:
-                                print(f"Warning: Invalid imgsize format: {a}")
-                    elif a.startswith('@camera='):
-                        # Parse @camera=150,50,250
-                        parts = a[8:].split(',')
-                        if len(parts) == 3:
-                            try:
-                                camera = (float(parts[0]), float(parts[1]), float(parts[2]))
-                            except ValueError:
-                                print(f"Warning: Invalid camera format: {a}")
-                    elif a.startswith('@border='):
-                        # Parse @border=20
-                        try:
-                            border = float(a[8:])
-                        except ValueError:
-                            print(f"Warning: Invalid border format: {a}")
-                    elif a.startswith('@colors='):
-                        # Parse @colors=Red,Blue,Green,#FF00FF,...
-                        try:
-                            color_string = a[8:].strip()
-                            if color_string:
-                                custom_colors = [c.strip() for c in color_string.split(',')]
-                            else:
-                                custom_colors = None
-                        except Exception as e:
-                            print(f"Warning: Invalid colors format: {a} - {e}")
-                            custom_colors = None
-                    else:
-                        idata.append(a)
+    run_main(options, do_section, file='validation/draw_nodes_labeled/labeled_test_set.txt')
 
 if __name__ == "__main__":
     main()
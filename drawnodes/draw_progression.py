@@ -5,17 +5,30 @@
 # write a .scad file to draw it using OpenSCAD 2D graphics, extruded to 3D.
 
 from sys import argv
+import os
+from bisect import bisect_left, bisect_right
 from collections import deque
+from functools import partial
 import subprocess
 import math
 
+try:
+    from .grid import parse, traceLinks, UR, LR, UL, LL, CL, VL
+    from .sinks import FileSink, temp_path
+    from .batch import run_main, run_command, run_steps
+except ImportError:  # Run as a script rather than from the package
+    from grid import parse, traceLinks, UR, LR, UL, LL, CL, VL
+    from sinks import FileSink, temp_path
+    from batch import run_main, run_command, run_steps
 
-def heading(ofile):
+
+def heading(ofile, stable=False):
+    # If stable, leave out the time, so the file depends only on its input
     import datetime
 
-    dt = datetime.datetime.today().strftime("%Y-%m-%d  %H:%M:%S")
+    dt = "" if stable else datetime.datetime.today().strftime(" %Y-%m-%d  %H:%M:%S")
     return (
-        f"// File {ofile}, generated {dt} by drawProgression"
+        f"// File {ofile}, generated{dt} by drawProgression"
         + """
 /* [Label Colors] */
 // Color for edge labels
@@ -211,23 +224,39 @@ def calculate_camera_params(bbox, border=0, scale=10, target_imgsize=None):
         return (center_x, center_y, z_height), (img_width, img_height)
 
 
-def generate_png(ofile, imgsize, camera, border=0):
+def generate_png(ofile, imgsize, camera, border=0, dir=".", log=None, timeout=None):
     """Generate PNG from SCAD file using OpenSCAD CLI
 
     Args:
         border: Border size in pixels (default 0). Applied via ImageMagick after trimming.
+        dir: Directory holding the SCAD file, where the PNG is written (default '.')
+        log: File to print messages to (default: stdout)
+        timeout: Seconds to allow openscad (default: None - 60)
+
+    Returns:
+        True if the PNG was generated and processed without error
+    """
+    return run_steps(png_steps(ofile, imgsize, camera, border, dir, log, timeout))
+
+def png_steps(ofile, imgsize, camera, border=0, dir=".", log=None, timeout=None):
+    """generate_png() as a generator, for a batch.Pipeline: it yields
+    once, after running openscad and before convert, so that the two can
+    run in different stages.  Its value is generate_png()'s.
     """
     if not imgsize or not camera:
-        print(f"Warning: Missing metadata for {ofile}, skipping PNG generation")
+        print(f"Warning: Missing metadata for {ofile}, skipping PNG generation", file=log)
         return
 
+    # Work on a temporary file beside the PNG, renamed into place when done,
+    # so readers never see a PNG that openscad or convert is still writing
+    tmp = temp_path(f"{ofile}.png", ".png")
     w, h = imgsize
     x, y, z = camera
 
     cmd = [
         "openscad",
         "-o",
-        f"{ofile}.png",
+        tmp,
         "--imgsize",
         f"{w},{h}",
         "--camera",
@@ -240,17 +269,17 @@ def generate_png(ofile, imgsize, camera, border=0):
     ]
 
     try:
-        print(f"Generating {ofile}.png...")
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=60)
+        print(f"Generating {ofile}.png...", file=log)
+        result = run_command(cmd, timeout or 60, dir)
         if result.returncode == 0:
-            print(f"Successfully generated {ofile}.png")
+            print(f"Successfully generated {ofile}.png", file=log)
 
             # Make background transparent, trim excess, and add border using ImageMagick
             # Cornfield colorscheme uses RGB(255,255,229) as background
             # Use -fuzz to handle anti-aliasing at edges
             convert_cmd = [
                 "convert",
-                f"{ofile}.png",
+                tmp,
                 "-fuzz",
                 "5%",
                 "-transparent",
@@ -262,57 +291,34 @@ def generate_png(ofile, imgsize, camera, border=0):
                 convert_cmd.extend(
                     ["-bordercolor", "none", "-border", str(int(border))]
                 )
-            convert_cmd.append(f"{ofile}.png")
+            convert_cmd.append(tmp)
 
-            print(f"Making background transparent and trimming...")
-            convert_result = subprocess.run(
-                convert_cmd, capture_output=True, text=True, timeout=30
-            )
+            yield               # On to the post stage, for convert
+            print(f"Making background transparent and trimming...", file=log)
+            convert_result = run_command(convert_cmd, 30, dir)
             if convert_result.returncode == 0:
                 if border > 0:
                     print(
-                        f"Successfully created transparent background with {int(border)}px border"
+                        f"Successfully created transparent background with {int(border)}px border",
+                        file=log,
                     )
                 else:
-                    print(f"Successfully created transparent background (trimmed)")
+                    print(f"Successfully created transparent background (trimmed)", file=log)
             else:
-                print(f"Warning: Could not process image: {convert_result.stderr}")
+                print(f"Warning: Could not process image: {convert_result.stderr}", file=log)
+            os.replace(os.path.join(dir, tmp), os.path.join(dir, f"{ofile}.png"))
+            return convert_result.returncode == 0
         else:
-            print(f"Error generating {ofile}.png: {result.stderr}")
+            print(f"Error generating {ofile}.png: {result.stderr}", file=log)
     except FileNotFoundError:
-        print("Error: openscad command not found. Please install OpenSCAD.")
+        print("Error: openscad command not found. Please install OpenSCAD.", file=log)
     except subprocess.TimeoutExpired:
-        print(f"Error: OpenSCAD timed out generating {ofile}.png")
+        print(f"Error: OpenSCAD timed out generating {ofile}.png", file=log)
     except Exception as e:
-        print(f"Error generating {ofile}.png: {e}")
-
-
-class Junction:
-    cc = ["UR", "LR", "UL", "LL", "CL", "VL"]
-
-    def __init__(self, num, row, col, code):
-        self.num, self.code = num, code
-        self.row, self.col = row, col
-        self.conn = []  # No links yet to any neighbors
-
-    def setConn(self, c):
-        if c and c not in self.conn:
-            self.conn.append(c)
-            c.setConn(self)
-
-    def canon(p, q):
-        return (
-            min(p.col, q.col),
-            max(p.col, q.col),
-            min(p.row, q.row),
-            max(p.row, q.row),
-        )
-
-    def __str__(self):
-        return f" {self.num:2} {self.row:2} {self.col:2} {self.cc[self.code]}"
-
-    def __repr__(self):
-        return f"{str(self)} {[str(c) for c in self.conn]}"
+        print(f"Error generating {ofile}.png: {e}", file=log)
+    finally:
+        if os.path.exists(os.path.join(dir, tmp)):
+            os.remove(os.path.join(dir, tmp))
 
 
 class Path:
@@ -412,92 +418,11 @@ class Path:
         return f"Path({self.label}, node={self.node_index}, start=({self.start_row},{self.start_col}), end=({self.end_row},{self.end_col}), segments={len(self.junctions)})"
 
 
-def process(idata, ofile, custom_colors=None):
-    UR, LR, UL, LL, CL, VL = range(6)  # Set Corner Codes + Vertical Line
-
-    def upChar(dx):  # Return neighbor char from previous line
-        if linn > 0 and (0 <= col + dx < len(idata[linn - 1])):
-            return idata[linn - 1][col + dx]
-        return "?"  # No character available?
-
-    def downChar(dx):  # Return neighbor char from next line
-        if linn < len(idata) - 1 and (0 <= col + dx < len(idata[linn + 1])):
-            return idata[linn + 1][col + dx]
-        return "?"  # No character available?
-
-    # Find locations of corners and collect text characters
-    corners, text_chars, linn, maxy = [], [], 0, len(idata)
-
-    for linn, l in enumerate(idata):
-        pc = None
-        for col, c in enumerate(l):
-            num = len(corners)
-            # Detect corners
-            if c == "/":
-                if upChar(0) in "|\\":  # Need to check LR before UL
-                    corners.append(Junction(num, linn, col, LR))  # Lower Right
-                elif (
-                    downChar(0) == "|"
-                ):  # Top of vertical line (path goes UP then RIGHT)
-                    corners.append(Junction(num, linn, col, UR))  # Upper Right
-                elif upChar(1) == "_":
-                    corners.append(Junction(num, linn, col, UL))  # Upper Left
-            elif c == "\\":
-                if upChar(0) in "|/":  # Need to check LL before UR
-                    corners.append(Junction(num, linn, col, LL))  # Lower Left
-                elif (
-                    downChar(0) == "|"
-                ):  # Top of vertical line (path goes UP then LEFT)
-                    corners.append(Junction(num, linn, col, UL))  # Upper Left
-                elif upChar(-1) == "_":
-                    corners.append(Junction(num, linn, col, UR))  # Upper Right
-            elif c == "|":
-                # Create VL junction at END of vertical runs (last | before non-|)
-                if downChar(0) != "|":
-                    corners.append(Junction(num, linn, col, VL))  # Vertical Line
-
-            # Collect text characters (anything that's not an edge character or space)
-            if c not in "|/\\_" and c not in " \t\n":
-                text_chars.append((linn, col, c))
-
-            pc = c
-        corners.append(Junction(0, 0, 0, 0))  # Need extra node for testing
-
-    def hhfind(cor):
-        # Search ALL corners on the same row, not just ones that come after
-        for c in corners:
-            if c.num == 0 or c.num == cor.num:  # Skip dummy corner and self
-                continue
-            # Any corner type on the same row can be a horizontal connection
-            if c.row == cor.row and c.code < CL:
-                # Check if there's a valid horizontal connection
-                min_col, max_col = min(cor.col, c.col), max(cor.col, c.col)
-                distance = max_col - min_col
-                if cor.row < len(idata):
-                    between = idata[cor.row][min_col + 1 : max_col]
-                    # Accept if: (1) has underscore, OR (2) short distance with no blocking corners
-                    has_underscore = "_" in between
-                    has_corner = any(ch in "/\\" for ch in between)
-                    is_short = (
-                        distance <= 15
-                    )  # Short connections don't need underscores (increased from 10 to 15)
-
-                    if has_underscore or (is_short and not has_corner):
-                        return corners[c.num]
-        return None  # not found??
-
-    def vvfind(cor):
-        for c in corners[1 + cor.num :]:
-            # Find any corner or VL junction in the same column
-            if (c.code in (LL, LR, UL, UR, VL)) and c.col == cor.col:
-                return corners[c.num]
-        return None  # not found??
-
-    for cor in corners:  # Connect up the pieces
-        if cor.code in (UL, LL, LR, UR):
-            cor.setConn(hhfind(cor))  # Find & set end-column
-        if cor.code in (UL, UR, LR, LL, VL):
-            cor.setConn(vvfind(cor))  # Find & set end-row
+def process(idata, ofile, custom_colors=None, grid=None, sink=None):
+    # Find and link corners, and collect text characters, unless the
+    # caller has a grid of idata already (eg from an IncrementalParser)
+    g = grid or parse(idata, "progression")
+    corners, text_chars, maxy = g.corners, g.text_chars, g.maxy
 
     # Identify label rows and build Path objects
     # Find rows that contain single-letter labels
@@ -535,6 +460,19 @@ def process(idata, ofile, custom_colors=None):
         # Sort output labels by column
         output_labels = sorted(label_rows[output_row], key=lambda x: x[0])
 
+        # Per-column junction lists ordered by row, so each tracing step
+        # is a bisect for the nearest junction above or below.  Corners
+        # are numbered in row order, so appending keeps each list sorted.
+        vvcols = {}  # col -> junctions other than dummies, top to bottom
+        vlcols = {}  # col -> VL junctions, top to bottom
+        for c in corners:
+            if c.num > 0:
+                vvcols.setdefault(c.col, []).append(c)
+            if c.code == VL:
+                vlcols.setdefault(c.col, []).append(c)
+        vvrows = {col: [j.row for j in js] for col, js in vvcols.items()}
+        vlrows = {col: [j.row for j in js] for col, js in vlcols.items()}
+
         def trace_path(start_col, visited=None):
             """Trace path from start_col following UP → ACROSS → DOWN pattern"""
             if visited is None:
@@ -542,14 +480,8 @@ def process(idata, ofile, custom_colors=None):
             segments = []
 
             # Find starting VL junction at start_col (closest | above the label)
-            start_junction = None
-            closest_dist = float("inf")
-            for c in corners:
-                if c.code == VL and c.col == start_col and c.row <= output_row:
-                    dist = output_row - c.row
-                    if dist < closest_dist:
-                        closest_dist = dist
-                        start_junction = c
+            k = bisect_right(vlrows.get(start_col, []), output_row)
+            start_junction = vlcols[start_col][k - 1] if k > 0 else None
 
             if not start_junction:
                 return segments, None
@@ -557,21 +489,17 @@ def process(idata, ofile, custom_colors=None):
             # Phase 1: Trace UPWARD from start_junction to find top corner (UL or UR)
             def trace_up(c):
                 """Trace upward by scanning for next junction above, return top corner with valid horizontal connections"""
-                # Find next junction in same column with row < c.row
-                next_junctions = [
-                    j for j in corners if j.col == c.col and j.row < c.row and j.num > 0
-                ]
-
-                if not next_junctions:
-                    return None
-
-                # Sort by row descending to get nearest one above
-                next_junctions.sort(key=lambda j: j.row, reverse=True)
-                d = next_junctions[0]
-
-                # Add segment from c to d
-                canon = c.canon(d)
-                if canon not in visited:
+                while True:
+                    # Find nearest junction above in same column
+                    k = bisect_left(vvrows.get(c.col, []), c.row)
+                    if k == 0:
+                        return None
+                    d = vvcols[c.col][k - 1]
+
+                    # Add segment from c to d
+                    canon = c.canon(d)
+                    if canon in visited:
+                        return None
                     visited.add(canon)
                     segments.append((c, d))
 
@@ -583,14 +511,11 @@ def process(idata, ofile, custom_colors=None):
                         ]
                         if horiz_conns:
                             return d
-                        else:
-                            # This corner can't connect horizontally, keep going up
-                            return trace_up(d)
+                        # This corner can't connect horizontally, keep going up
                     # Continue up through VL junctions
-                    elif d.code == VL:
-                        return trace_up(d)
-
-                return None
+                    elif d.code != VL:
+                        return None
+                    c = d
 
             top_corner = trace_up(start_junction)
             if not top_corner:
@@ -631,21 +556,18 @@ def process(idata, ofile, custom_colors=None):
             # Phase 3: Trace DOWNWARD from far_corner to input row
             def trace_down(c):
                 """Trace downward by scanning for next junction below, return end column"""
-                # Find next junction in same column with row > c.row
-                next_junctions = [
-                    j for j in corners if j.col == c.col and j.row > c.row and j.num > 0
-                ]
-
-                if not next_junctions:
-                    return None
-
-                # Sort by row to get nearest one below
-                next_junctions.sort(key=lambda j: j.row)
-                d = next_junctions[0]
-
-                # Add segment from c to d
-                canon = c.canon(d)
-                if canon not in visited:
+                while True:
+                    # Find nearest junction below in same column
+                    rows = vvrows.get(c.col, [])
+                    k = bisect_right(rows, c.row)
+                    if k == len(rows):
+                        return None
+                    d = vvcols[c.col][k]
+
+                    # Add segment from c to d
+                    canon = c.canon(d)
+                    if canon in visited:
+                        return None
                     visited.add(canon)
                     segments.append((c, d))
 
@@ -654,12 +576,9 @@ def process(idata, ofile, custom_colors=None):
                     if d.code == VL and d.row >= input_row - 1:
                         return d.col
                     # Continue down through any junction type
-                    elif d.code == VL or d.code < VL:
-                        result = trace_down(d)
-                        if result is not None:
-                            return result
-
-                return None
+                    elif not (d.code == VL or d.code < VL):
+                        return None
+                    c = d
 
             end_col = trace_down(far_corner)
             return segments, end_col
@@ -741,23 +660,19 @@ def process(idata, ofile, custom_colors=None):
             )
 
     def colorTrace(c, d):
-        if c.canon(d) in drawn:
-            return
-        code = c.code
-        # Draw c to d
-        if code < CL:  # Only draw corners for actual corner codes (not VL)
-            drawCorner(c)
-        drawH(c, d.col)  # Draw to end-column, if ok
-        drawV(c, d.row)  # Draw to end-row, if ok
-        drawn[c.canon(d)] = 1
-
         # Continue tracing through all connections (corners and VL junctions)
-        # The drawn dictionary prevents infinite loops
-        for e in d.conn:
-            colorTrace(d, e)
-
-    with open(ofile + ".scad", "w") as fout:
-        fout.write(heading(ofile))  # Write drawing modules
+        # The drawn set prevents infinite loops
+        for c, d in traceLinks(c, d, drawn):
+            # Draw c to d
+            if c.code < CL:  # Only draw corners for actual corner codes (not VL)
+                drawCorner(c)
+            drawH(c, d.col)  # Draw to end-column, if ok
+            drawV(c, d.row)  # Draw to end-row, if ok
+
+    # Write via sink, by default to a file in the current directory
+    sink = sink or FileSink()
+    with sink.open(ofile + ".scad") as fout:
+        fout.write(heading(ofile, sink.stable))  # Write drawing modules
 
         # Draw colored traces using Path objects
         # Paths are already built in left-to-right order from sorted output labels
@@ -781,7 +696,7 @@ def process(idata, ofile, custom_colors=None):
                 fout.write("  }\n")
         else:
             # Fallback to old behavior if no paths found
-            drawn = {}
+            drawn = set()
             colorNum = 0
             for b in corners:
                 if not b.conn:
@@ -825,6 +740,13 @@ def process(idata, ofile, custom_colors=None):
             # Not a negation pattern, add as is
             combined_chars.append((row, col, char))
 
+        # Index combined text by row; combined_chars is sorted by (row, col),
+        # so each row's token list is already in column order
+        tokens_by_row = {}  # row -> list of (col, text)
+        for row, col, text in combined_chars:
+            tokens_by_row.setdefault(row, []).append((col, text))
+        token_cols = {row: [col for col, _ in toks] for row, toks in tokens_by_row.items()}
+
         # Build diagonal lines using existing Path data
         diagonal_lines = []  # List of (x1, y1, x2, y2) tuples
 
@@ -832,86 +754,79 @@ def process(idata, ofile, custom_colors=None):
             # Group paths by node to get out1/out2 positions
             nodes_data = {}  # node_index -> {'out1_col': x, 'out2_col': y}
 
-            for path in paths:
+            for path_idx, path in enumerate(paths):
                 node_idx = path.node_index
                 if node_idx not in nodes_data:
                     nodes_data[node_idx] = {}
 
                 # Even indices are out1, odd are out2
-                path_idx = paths.index(path)
                 if path_idx % 2 == 0:
                     nodes_data[node_idx]['out1_col'] = path.start_col
                 else:
                     nodes_data[node_idx]['out2_col'] = path.start_col
 
-            # Find all rows that contain '+' characters (operation rows)
-            operation_rows = set()
-            for row, col, text in combined_chars:
-                if text == '+':
-                    operation_rows.add(row)
+            # Find columns of '+' characters in each operation row
+            plus_cols = {}  # operation row -> columns of '+', left to right
+            for row, toks in tokens_by_row.items():
+                cols = [col for col, text in toks if text == '+']
+                if cols:
+                    plus_cols[row] = cols
 
             # For each operation row, find diagonal lines from in2 to out1
             # Structure: operation_row has "in1 + in2", result_row (operation_row+1) has outputs
-            for operation_row in sorted(operation_rows):
+            for operation_row in sorted(plus_cols):
                 result_row = operation_row + 1
+                cols = plus_cols[operation_row]
 
                 for node_idx, node_data in nodes_data.items():
                     if 'out1_col' in node_data and 'out2_col' in node_data:
                         out1_col = node_data['out1_col']
 
-                        # Find '+' character near this node's outputs (operations are stored as individual chars)
-                        for row, col, text in combined_chars:
-                            if row == operation_row and text == '+':
-                                # Operation starts at col-1, in2 is at col+1
-                                op_start_col = col - 1
-                                in2_col = col + 1
-
-                                # Check if this operation is roughly above this node's outputs
-                                if abs(op_start_col - out1_col) <= 5:
-                                    # Add diagonal from in2 (on operation_row) to out1 (on result_row)
-                                    # Shorten line to avoid obscuring text: start 0.3 below in2, end 0.3 above out1
-                                    # Then shorten by 20% (move each endpoint 10% toward center)
-                                    # Plus extra shortening at arrow end to stop inside arrow
-                                    x1, y1 = in2_col, operation_row + 0.3
-                                    x2, y2 = out1_col, result_row - 0.3
-                                    dx = x2 - x1
-                                    dy = y2 - y1
-                                    length = math.sqrt(dx * dx + dy * dy)
-                                    # Diagonal arrow height is 0.6*1.25*wFrac = 0.1875
-                                    # Shorten by ~0.7 of that = 0.13 units along the line
-                                    # Keep x1, y1 as original position (for translate), only shorten x2, y2
-                                    arrow_adjust = 0.13
-                                    new_x1 = x1 + 0.1 * dx
-                                    new_y1 = y1 + 0.1 * dy
-                                    new_x2 = x2 - 0.1 * dx - arrow_adjust * dx / length
-                                    new_y2 = y2 - 0.1 * dy - arrow_adjust * dy / length
-                                    diagonal_lines.append((new_x1, new_y1, new_x2, new_y2))
-                                    break
+                        # Find the first '+' roughly above this node's outputs: the
+                        # operation starts at col-1, which must be within 5 of out1_col
+                        k = bisect_left(cols, out1_col - 4)
+                        if k < len(cols) and cols[k] <= out1_col + 6:
+                            col = cols[k]
+                            # Operation starts at col-1, in2 is at col+1
+                            in2_col = col + 1
+                            # Add diagonal from in2 (on operation_row) to out1 (on result_row)
+                            # Shorten line to avoid obscuring text: start 0.3 below in2, end 0.3 above out1
+                            # Then shorten by 20% (move each endpoint 10% toward center)
+                            # Plus extra shortening at arrow end to stop inside arrow
+                            x1, y1 = in2_col, operation_row + 0.3
+                            x2, y2 = out1_col, result_row - 0.3
+                            dx = x2 - x1
+                            dy = y2 - y1
+                            length = math.sqrt(dx * dx + dy * dy)
+                            # Diagonal arrow height is 0.6*1.25*wFrac = 0.1875
+                            # Shorten by ~0.7 of that = 0.13 units along the line
+                            # Keep x1, y1 as original position (for translate), only shorten x2, y2
+                            arrow_adjust = 0.13
+                            new_x1 = x1 + 0.1 * dx
+                            new_y1 = y1 + 0.1 * dy
+                            new_x2 = x2 - 0.1 * dx - arrow_adjust * dx / length
+                            new_y2 = y2 - 0.1 * dy - arrow_adjust * dy / length
+                            diagonal_lines.append((new_x1, new_y1, new_x2, new_y2))
 
         # Find rows that contain "=" (truth table rows)
         # Track both the "=" position and which columns are out1 vs out2
-        rows_with_equals = {}  # row → column position of "="
         truth_table_out1_cols = set()  # Columns for out1 in truth table
         truth_table_out2_cols = set()  # Columns for out2 in truth table
 
-        for row, col, text in combined_chars:
-            if "=" in text:
-                # Find position of "=" within the text
-                eq_pos = text.index("=")
-                rows_with_equals[row] = col + eq_pos
-
-        # For each truth table row, identify which columns after "=" are out1 vs out2
-        for row in rows_with_equals:
-            eq_col = rows_with_equals[row]
-            # Find all characters after "=" in this row
-            chars_after_eq = [(c, t) for r, c, t in combined_chars if r == row and c > eq_col]
-            # Sort by column position
-            chars_after_eq.sort(key=lambda x: x[0])
-            # First character is out1, second is out2
-            if len(chars_after_eq) >= 1:
-                truth_table_out1_cols.add(chars_after_eq[0][0])
-            if len(chars_after_eq) >= 2:
-                truth_table_out2_cols.add(chars_after_eq[1][0])
+        for row, toks in tokens_by_row.items():
+            # Position of "=" within the row (the rightmost token holding one wins)
+            eq_col = None
+            for col, text in toks:
+                if "=" in text:
+                    eq_col = col + text.index("=")
+            if eq_col is None:
+                continue
+            # Characters after "=" in this row: first is out1, second is out2
+            k = bisect_right(token_cols[row], eq_col)
+            if k < len(toks):
+                truth_table_out1_cols.add(toks[k][0])
+            if k + 1 < len(toks):
+                truth_table_out2_cols.add(toks[k + 1][0])
 
         # Draw diagonal lines from second input to first output
         if diagonal_lines:
@@ -980,12 +895,8 @@ def process(idata, ofile, custom_colors=None):
         min_col = min_row = float("inf")
         max_col = max_row = float("-inf")
 
-        for c in corners:
-            if c.code != 0:
-                min_col = min(min_col, c.col)
-                max_col = max(max_col, c.col)
-                min_row = min(min_row, c.row)
-                max_row = max(max_row, c.row)
+        if g.bbox:
+            min_col, max_col, min_row, max_row = g.bbox
 
         for row, col, text in combined_chars:
             min_col = min(min_col, col)
@@ -1010,10 +921,55 @@ def process(idata, ofile, custom_colors=None):
     return (min_col, max_col, min_row, max_row, maxy)
 
 
+def do_section(sec, options, sink):
+    # Write the outputs for input section sec, through sink (in a worker
+    # process, with the jobs option)
+    imgsize, camera, border = sec.get("imgsize"), sec.get("camera"), sec.get("border")
+    # With png, a file sink locks the section's files while making
+    # them; an archive sink stages them on disk for openscad
+    with sink.staging(sec.name, options["png"]) as stage:
+        # Process the SCAD file (file is fully written when this returns)
+        bbox = process(sec.lines, sec.name, sec.get("colors"), sink=stage)
+
+        # Generate PNG if requested
+        if options["png"]:
+            # Use default border if not specified (10 pixels provides clean margin)
+            final_border = border if border is not None else 10
+
+            # Calculate camera/imgsize from bounding box (always with border=0 for tight fit)
+            # Border is applied later via ImageMagick trim+border
+            calc_camera, calc_imgsize = calculate_camera_params(
+                bbox, border=0, target_imgsize=imgsize
+            )
+
+            # Use explicit camera if provided, otherwise use calculated
+            final_camera = camera if camera else calc_camera
+            final_imgsize = imgsize if imgsize else calc_imgsize
+
+            # Print calculated values for user reference
+            if border is None:
+                print(f"Calculated border: @border={final_border}")
+            if not camera:
+                print(
+                    f"Calculated camera: @camera={calc_camera[0]:.1f},{calc_camera[1]:.1f},{calc_camera[2]:.1f}"
+                )
+            if not imgsize:
+                print(
+                    f"Calculated imgsize: @imgsize={calc_imgsize[0]},{calc_imgsize[1]}"
+                )
+
+            # Make the PNG (in the background, with the renders option),
+            # unless stable and its .scad and parameters haven't changed;
+            # pass final_border to ImageMagick for pixel-based border after trimming
+            render = partial(png_steps, sec.name, final_imgsize, final_camera, final_border)
+            stage.make(sec.name + ".png", [sec.name + ".scad"],
+                       [final_imgsize, final_camera, final_border], render)
+
+
 def main():
     # Set up default options
-    options = {"file": "validation/draw_progression/progression.txt", "png": ""}
-    arn, idata = 0, []
+    options = {"file": "", "png": "", "only": "", "out": "", "stable": "", "jobs": "", "renders": "", "posts": "", "shard": "", "merge": "", "enqueue": "", "work": "", "lease": "", "resume": "", "journal": ""}
+    arn = 0
     while (arn := arn + 1) < len(argv):
         if "=" in argv[arn]:
             opt, val = argv[arn].split("=")
@@ -1021,133 +977,7 @@ def main():
         else:
             options["file"] = argv[arn]  # Default case = file name
 
-    with open(options["file"], "r") as fin:
-        # Parse global options (before first diagram)
-        global_options = {}
-        # First pass: read global options (lines before first =)
-        while True:
-            pos = fin.tell()  # Save position before reading
-            a = fin.readline()
-            if not a:  # EOF
-                break
-            if a[0] == "=":
-                # Found first diagram, go back to this line
-                fin.seek(pos)
-                break
-            # Parse global options
-            a = a.rstrip()
-            if a.startswith("@imgsize="):
-                parts = a[9:].split(",")
-                if len(parts) == 2:
-                    try:
-                        global_options["imgsize"] = (int(parts[0]), int(parts[1]))
-                    except ValueError:
-                        print(f"Warning: Invalid global imgsize format: {a}")
-            elif a.startswith("@camera="):
-                parts = a[8:].split(",")
-                if len(parts) == 3:
-                    try:
-                        global_options["camera"] = (
-                            float(parts[0]),
-                            float(parts[1]),
-                            float(parts[2]),
-                        )
-                    except ValueError:
-                        print(f"Warning: Invalid global camera format: {a}")
-            elif a.startswith("@border="):
-                try:
-                    global_options["border"] = float(a[8:])
-                except ValueError:
-                    print(f"Warning: Invalid global border format: {a}")
-            elif a.startswith("@colors="):
-                try:
-                    color_string = a[8:].strip()
-                    if color_string:
-                        global_options["colors"] = [
-                            c.strip() for c in color_string.split(",")
-                        ]
-                except Exception as e:
-                    print(f"Warning: Invalid global colors format: {a} - {e}")
-
-        # Second pass: process diagrams
-        while a := fin.readline():
-            # Read text for one diagram; send that text to process().
-            if a[0] == "=":  # Detect opening =
-                idata, ofile = [], a[1:].rstrip()
-                # Initialize with global defaults
-                imgsize = global_options.get("imgsize", None)
-                camera = global_options.get("camera", None)
-                border = global_options.get("border", None)
-                custom_colors = global_options.get("colors", None)
-
-                while a := fin.readline():  # Allow blank lines
-                    a = a.rstrip()  # Drop ending whitespace
-                    if a and a == "=":  # Detect closing =
-                        # Process the SCAD file (file is fully written when this returns)
-                        bbox = process(idata, ofile, custom_colors)
-
-                        # Generate PNG if requested
-                        if options["png"]:
-                            # Use default border if not specified (10 pixels provides clean margin)
-                            final_border = border if border is not None else 10
-
-                            # Calculate camera/imgsize from bounding box (always with border=0 for tight fit)
-                            # Border is applied later via ImageMagick trim+border
-                            calc_camera, calc_imgsize = calculate_camera_params(
-                                bbox, border=0, target_imgsize=imgsize
-                            )
-
-                            # Use explicit camera if provided, otherwise use calculated
-                            final_camera = camera if camera else calc_camera
-                            final_imgsize = imgsize if imgsize else calc_imgsize
-
-                            # Print calculated values for user reference
-                            if border is None:
-                                print(f"Calculated border: @border={final_border}")
-                            if not camera:
-                                print(
-                                    f"Calculated camera: @camera={calc_camera[0]:.1f},{calc_camera[1]:.1f},{calc_camera[2]:.1f}"
-                                )
-                            if not imgsize:
-                                print(
-                                    f"Calculated imgsize: @imgsize={calc_imgsize[0]},{calc_imgsize[1]}"
-                                )
-
-                            # Pass final_border to ImageMagick for pixel-based border after trimming
-                            generate_png(ofile, final_imgsize, final_camera, final_border)
-                        break
-                    elif a.startswith("@imgsize="):
-                        parts = a[9:].split(",")
-                        if len(parts) == 2:
-                            try:
-                                imgsize = (int(parts[0]), int(parts[1]))
-                            except ValueError:
-                                print(f"Warning: Invalid imgsize format: {a}")
-                    elif a.startswith("@camera="):
-                        parts = a[8:].split(",")
-                        if len(parts) == 3:
-                            try:
-                                camera = (float(parts[0]), float(parts[1]), float(parts[2]))
-                            except ValueError:
-                                print(f"Warning: Invalid camera format: {a}")
-                    elif a.startswith("@border="):
-                        try:
-                            border = float(a[8:])
-                        except ValueError:
-                            print(f"Warning: Invalid border format: {a}")
-                    elif a.startswith("@colors="):
-                        # Parse @colors=Red,Blue,Green,#FF00FF,...
-                        try:
-                            color_string = a[8:].strip()
-                            if color_string:
-                                custom_colors = [c.strip() for c in color_string.split(",")]
-                            else:
-                                custom_colors = None
-                        except Exception as e:
-                            print(f"Warning: Invalid colors format: {a} - {e}")
-                            custom_colors = None
-                    else:
-                        idata.append(a)
+    run_main(options, do_section, file="validation/draw_progression/progression.txt")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,717 @@
+#!/usr/bin/env python3
+# -*- mode: python -*-
+
+# Shared grid parser for drawNodes, drawNodesLabeled and drawProgression.
+
+# parse() makes one pass over the lines of a diagram section, finding
+# corners, vertical-line ends, node hashmarks, X-marks, edge labels and
+# text, and then links the junctions into a graph.  The three programs
+# classify a few characters differently, so parse() takes a style:
+#   'nodes'        drawNodes.py rules
+#   'labeled'      drawNodesLabeled.py rules (lowercase letters are labels)
+#   'progression'  drawProgression.py rules (| runs end in VL junctions)
+
+import re
+from bisect import bisect_left, bisect_right, insort
+from itertools import accumulate, chain, repeat
+try:
+    import numpy as np          # Optional; enables the 'numpy' engine
+except ImportError:
+    np = None
+
+# Corner & mark codes.  dy, dx of a corner's quarter-circle are code&1
+# and code//2, so the corner codes must stay in this order.
+UR, LR, UL, LL, CL, XM, HM, HX, VL = range(9)
+#==============================================================
+class Junction:
+    # Slots, not a per-instance __dict__: big diagrams make ~10^6 of these
+    __slots__ = ('num', 'code', 'row', 'col', 'conn')
+    cc = ['UR','LR','UL','LL','CL','XM','HM','HX','VL']
+    def __init__(self, num, row, col, code):
+        self.num, self.code = num, code
+        self.row, self.col  = row, col
+        self.conn  = ()         # No links yet to any neighbors
+    def setConn(self, c):
+        # conn is a tuple, not a list: junctions have at most a few links,
+        # and a tuple of them is smaller than a list with spare capacity
+        if c and c not in self.conn:
+            self.conn += (c,)
+            c.setConn(self)
+    def canon(p,q):
+        # Key of edge p-q, the same for q-p: its min & max col and min &
+        # max row, packed 32 bits apiece into one int (cheaper to hash
+        # and store than the equivalent 4-tuple)
+        c0, c1 = (p.col, q.col) if p.col < q.col else (q.col, p.col)
+        r0, r1 = (p.row, q.row) if p.row < q.row else (q.row, p.row)
+        return c0<<96 | c1<<64 | r0<<32 | r1
+    def __str__(self):
+        return f' {self.num:2} {self.row:2} {self.col:2} {self.cc[self.code]}'
+    def __repr__(self): return f'{str(self)} {[str(c) for c in self.conn]}'
+#==============================================================
+class Node:
+    # A run of #s in one row: an HM junction and the HX junctions after it
+    __slots__ = ('hm', 'row', 'col', 'junctions', 'xfar')
+    def __init__(self, hm):
+        self.hm, self.row, self.col = hm, hm.row, hm.col
+        self.junctions = [hm]
+        self.xfar = 1           # Width of node, in columns
+    def extend(self, hx):
+        self.junctions.append(hx)
+        self.xfar += 1
+    @property
+    def out2_col(self):         # Rightmost column, where out2 leaves
+        return self.col + self.xfar - 1
+    @property
+    def out_cols(self):         # Output columns, first and last of the extent
+        return (self.col, self.out2_col) if self.xfar > 1 else (self.col,)
+#==============================================================
+class Grid:
+    '''Result of parse(): the linked junction graph plus everything else
+    the renderers need from a diagram section.
+
+    corners   all junctions, in row-major order; corners[j.num] is j,
+              except for the sentinel that ends each junction line
+    nodes     HM and HX junctions;  nodetab: one Node per run of #s
+    owner     HX junction number -> HM junction of its node
+    xlist     X-mark junctions
+    labels    row -> [(col, letter), ...] lowercase letters, by column
+              ('labeled' style only)
+    chars     [(row, line), ...] lines treated as text ('nodes' and
+              'labeled' styles)
+    text_chars  [(row, col, char), ...] non-edge characters
+              ('progression' style only)
+    bbox      (min_col, max_col, min_row, max_row) of the junctions
+              other than code-0 ones, or None if there are none
+    maxy      number of lines
+    '''
+    def __init__(self, idata, style):
+        self.idata, self.style, self.maxy = idata, style, len(idata)
+        self.corners, self.nodes, self.nodetab, self.xlist = [], [], [], []
+        self.owner, self.labels, self.chars, self.text_chars = {}, {}, [], []
+        self.bbox = None
+#==============================================================
+_nodeChars  = re.compile(r'[/\\#X]')            # Junction chars, nodes styles
+_notDrawing = re.compile(r'[^X#|_ /\\]')        # Text-line test, 'nodes' style
+_drawing    = re.compile(r'[X#_ /\\]')          # 'labeled' style: any drawing char?
+_otherChars = re.compile(r'[^X#|_ /\\\s]')      # 'labeled' style: maybe-other chars
+_letters    = re.compile(r'[^\W\d_]')           # Candidate lowercase letters
+_progChars  = re.compile(r'[^_ \t\n]')          # Junction or text chars, 'progression'
+_numpyCells = 50000     # engine='auto' uses NumPy for sections at least this big
+
+def _isLabel(c): return c.isalpha() and c.islower()
+
+def parse(idata, style='nodes', engine='auto'):
+    '''Classify and link one diagram section; return a Grid.
+
+    engine selects how cells are classified: 'python' walks each line,
+    'numpy' classifies the whole section at once with array operations,
+    and 'auto' uses NumPy, when it is installed, for large sections.
+    Both engines give identical results.'''
+    g = Grid(idata, style)
+    # Pad every line to a common width, with at least one trailing
+    # space, so that neighbor lookups need no bounds checks: col-1 at
+    # column 0 wraps around to that padding.
+    width = max(map(len, idata), default=0) + 2
+    blank = ' ' * width
+    padded = [l.ljust(width) for l in idata]
+    if engine == 'auto':
+        engine = 'numpy' if np is not None and len(idata)*width >= _numpyCells else 'python'
+    elif engine == 'numpy' and np is None:
+        raise ImportError("parse engine 'numpy' needs NumPy installed")
+    numpy = engine == 'numpy'
+    if style == 'progression':
+        codes = _progCodesNumpy(g, padded, blank) if numpy else \
+            _progCodes(idata, padded, blank, range(len(idata)), g.text_chars)
+        _buildProgression(g, codes)
+        _linkProgression(g)
+    else:
+        rows = _textLines(g)
+        codes = _nodeCodesNumpy(padded, blank, rows) if numpy else _nodeCodes(g.idata, padded, blank, rows)
+        _linkNodes(g, *_buildNodes(g, rows, codes))
+    codes = [(c.col, c.row) for c in g.corners if c.code != 0]
+    if codes:
+        cols, rows = zip(*codes)
+        g.bbox = (min(cols), max(cols), min(rows), max(rows))
+    return g
+
+def traceLinks(c, d, seen, follow=None):
+    '''Yield the links of the trace that starts with link c-d, in the
+    order a recursive depth-first walk would visit them.
+
+    A link whose canon() key is in seen is skipped.  Otherwise its key
+    is added to seen and the link is yielded.  Then, if follow is None
+    or follow(d) is true, the walk goes on to the links from d to each
+    junction in d.conn.  The walk keeps an explicit stack, so a trace
+    may be any length.'''
+    stack = [iter(((c, d),))]
+    while stack:
+        for c, d in stack[-1]:
+            key = c.canon(d)
+            if key not in seen:
+                seen.add(key)
+                yield c, d
+                if follow is None or follow(d):
+                    stack.append(zip(repeat(d), d.conn))
+                break
+        else:
+            stack.pop()
+#==============================================================
+def _textLines(g):
+    # Sort lines into text lines and junction lines, and find labels.
+    # Return the numbers of the junction lines.
+    rows, labeled = [], g.style == 'labeled'
+    for linn, l in enumerate(g.idata):
+        if labeled:
+            labs = _lineLabels(l)
+            if labs: g.labels[linn] = labs
+        if _isTextLine(l, labeled):
+            g.chars.append((linn,l)); continue
+        rows.append(linn)   # Now l only has drawing characters, and maybe labels
+    return rows
+
+def _lineLabels(l):     # Labels (single lowercase letters) in a line
+    return [(m.start(), m.group()) for m in _letters.finditer(l) if _isLabel(m.group())]
+
+def _isTextLine(l, labeled):
+    if labeled:
+        # A line is text if it has no drawing characters or has
+        # any non-drawing, non-space, non-label characters
+        return not _drawing.search(l) or any(not (c.isspace() or _isLabel(c))
+                                             for c in _otherChars.findall(l))
+    return bool(_notDrawing.search(l))
+
+def _nodeCodes(idata, padded, blank, rows):
+    # For each junction line, yield a list of (col, code) of its junctions
+    for linn in rows:
+        l, up, codes = idata[linn], padded[linn-1] if linn else blank, []
+        for m in _nodeChars.finditer(l):
+            col, c = m.start(), m.group()
+            if c=='/':
+                if up[col] in '|#\\':   # Need to check LR before UL
+                    code = LR           # Lower Right
+                elif up[col+1]=='_':
+                    code = UL           # Upper Left
+                else: continue
+            elif c=='\\':
+                if up[col] in '|#/':    # Need to check LL before UR
+                    code = LL           # Lower Left
+                elif up[col-1]=='_':
+                    code = UR           # Upper Right
+                else: continue
+            elif c=='#':
+                code = HX if col and l[col-1]=='#' else HM
+            else:
+                code = XM               # Xmark
+            codes.append((col, code))
+        yield codes
+
+def _buildNodes(g, rows, rowCodes):
+    # Make junctions, the node table and HX owners from classified lines.
+    # Also index the junctions that hhfind and vvfind look for, so that
+    # each link can be resolved by bisecting a per-row or per-column
+    # list of corner numbers instead of rescanning the corners list.
+    corners, nodes, nodetab = g.corners, g.nodes, g.nodetab
+    hhrows, vvcols = {}, {}     # row -> [UR/LR nums];  col -> [LL/LR/XM/HM/HX nums]
+    for linn, codes in zip(rows, rowCodes):
+        for col, code in codes:
+            num = len(corners)
+            j = Junction(num, linn, col, code)
+            corners.append(j)
+            if code in (UR, LR):
+                hhrows.setdefault(linn, []).append(num)
+            elif code in (LL, XM, HM, HX):
+                if code == XM: g.xlist.append(j)
+                elif code == HM:
+                    nodes.append(j); nodetab.append(Node(j))
+                elif code == HX:
+                    nodes.append(j); nodetab[-1].extend(j)
+                    g.owner[num] = nodetab[-1].hm
+            if code in (LL, LR) or code > CL:
+                vvcols.setdefault(col, []).append(num)
+        # Extra junction ending each junction line.  Its number is
+        # counted in every later junction's number (which is drawn as
+        # corner labels), and it looks like a UR at row 0 to hhfind,
+        # so index it as one to keep links unchanged.
+        hhrows.setdefault(0, []).append(len(corners))
+        corners.append(Junction(0,0,0,0))
+    return hhrows, vvcols
+
+def _linkNodes(g, hhrows, vvcols):
+    corners = g.corners
+    def hhfind(cor):   # Find first UR or LR after cor in its row
+        nums = hhrows.get(cor.row, ())
+        k = bisect_right(nums, cor.num)
+        return corners[corners[nums[k]].num] if k < len(nums) else None
+    def vvfind(cor):   # Find first LL, LR, or mark after cor in its column
+        nums = vvcols.get(cor.col, ())
+        k = bisect_right(nums, cor.num)
+        return corners[nums[k]] if k < len(nums) else None
+
+    for cor in corners:         # Connect up the pieces
+        if cor.code in (UL, LL):
+            cor.setConn(hhfind(cor))    # Find & set end-column
+        if cor.code in (UL, UR, HM, HX):
+            cor.setConn(vvfind(cor))    # Find & set end-row
+#==============================================================
+def _progCodes(idata, padded, blank, rows, text_chars):
+    # For each of the given lines, yield a list of (col, code) of its
+    # junctions, and collect text characters into text_chars
+    maxy = len(idata)
+    for linn in rows:
+        l = idata[linn]
+        up = padded[linn-1] if linn else blank
+        down = padded[linn+1] if linn+1 < maxy else blank
+        codes = []
+        for m in _progChars.finditer(l):
+            col, c = m.start(), m.group()
+            # Detect corners
+            if c == '/':
+                if up[col] in '|\\':    # Need to check LR before UL
+                    code = LR           # Lower Right
+                elif down[col] == '|':  # Top of vertical line (path goes UP then RIGHT)
+                    code = UR           # Upper Right
+                elif up[col+1] == '_':
+                    code = UL           # Upper Left
+                else: continue
+            elif c == '\\':
+                if up[col] in '|/':     # Need to check LL before UR
+                    code = LL           # Lower Left
+                elif down[col] == '|':  # Top of vertical line (path goes UP then LEFT)
+                    code = UL           # Upper Left
+                elif up[col-1] == '_':
+                    code = UR           # Upper Right
+                else: continue
+            elif c == '|':
+                # Create VL junction at END of vertical runs (last | before non-|)
+                if down[col] == '|': continue
+                code = VL               # Vertical Line
+            else:
+                # Collect text characters (anything that's not an edge character or space)
+                text_chars.append((linn, col, c))
+                continue
+            codes.append((col, code))
+        yield codes
+
+def _buildProgression(g, rowCodes):
+    corners = g.corners
+    for linn, codes in enumerate(rowCodes):
+        for col, code in codes:
+            corners.append(Junction(len(corners), linn, col, code))
+        corners.append(Junction(0, 0, 0, 0))  # Extra junction ending each line
+
+def _progHH(cor, cors, cols, us, sl):
+    # Search ALL corners on the same row, not just ones that come after,
+    # and return the leftmost one that has a valid horizontal connection.
+    # cors are the row's corners, left to right, and cols their columns;
+    # us and sl are prefix counts of underscores and slashes in the row.
+    def linked(c):
+        # Accept if: (1) has underscore, OR (2) short distance with no blocking corners
+        # Short connections don't need underscores (increased from 10 to 15)
+        min_col, max_col = min(cor.col, c.col), max(cor.col, c.col)
+        has_underscore = us[max_col] > us[min_col + 1]
+        has_corner = sl[max_col] > sl[min_col + 1]
+        return has_underscore or (max_col - min_col <= 15 and not has_corner)
+
+    # Every corner sits on a / or \, so only the nearest corner on each
+    # side can pass the short-distance test, while the underscore test
+    # passes for every corner beyond the first underscore.
+    k = bisect_left(cols, cor.col)
+    if k:                       # Index, don't slice: a slice would copy the row
+        if linked(cors[0]):
+            return cors[0]
+        if linked(cors[k-1]):
+            return cors[k-1]
+    if k < len(cors) and cors[k] is cor:
+        k += 1
+    if k < len(cors):
+        if linked(cors[k]):
+            return cors[k]
+        # First column after cor.col that follows an underscore
+        after = bisect_right(us, us[cor.col + 1])
+        k = bisect_left(cols, after)
+        if k < len(cors):
+            return cors[k]
+    return None  # not found??
+
+def _progRow(l):
+    # Prefix counts of underscores and slashes in line l, for _progHH
+    return (list(accumulate((ch == '_' for ch in l), initial=0)),
+            list(accumulate((ch in '/\\' for ch in l), initial=0)))
+
+def _linkProgression(g):
+    corners, idata = g.corners, g.idata
+    # Per-row lists of corners (ordered by column), plus per-row prefix
+    # counts of underscores and slashes, so hhfind can test whether the
+    # text between two corners links them in O(1).  Per-column lists of
+    # junction positions serve vvfind; the line-ending sentinels count
+    # as URs in column 0 there, as they always have.
+    hhrows, vvcols = {}, {}  # row -> corners hhfind may return, left to right; col -> positions
+    for i, c in enumerate(corners):
+        if c.num > 0 and c.code < CL:  # Skip dummy corners
+            hhrows.setdefault(c.row, []).append(c)
+        vvcols.setdefault(c.col, []).append(i)
+    hhcols = {row: [c.col for c in cors] for row, cors in hhrows.items()}
+    underscores, slashes = {}, {}  # row -> prefix counts for that row's text
+    for row in hhrows:
+        underscores[row], slashes[row] = _progRow(idata[row])
+
+    def hhfind(cor):
+        cors = hhrows.get(cor.row)
+        if not cors:
+            return None
+        return _progHH(cor, cors, hhcols[cor.row], underscores[cor.row], slashes[cor.row])
+
+    def vvfind(cor):   # Find any corner or VL junction after cor in its column
+        nums = vvcols.get(cor.col, ())
+        k = bisect_right(nums, cor.num)
+        return corners[corners[nums[k]].num] if k < len(nums) else None
+
+    for cor in corners:  # Connect up the pieces
+        if cor.code in (UL, LL, LR, UR):
+            cor.setConn(hhfind(cor))  # Find & set end-column
+        if cor.code in (UL, UR, LR, LL, VL):
+            cor.setConn(vvfind(cor))  # Find & set end-row
+#==============================================================
+# NumPy engine.  The section is loaded into a 2D array of character
+# codes, and every cell is classified at once by comparing it with
+# copies of the array shifted one row or column.  The rules are the
+# same as in _nodeCodes and _progCodes; where two rules could match a
+# cell, the one those functions check first is applied last.
+def _charArray(lines, width):
+    text = ''.join(lines)
+    if text.isascii():
+        return np.frombuffer(text.encode('ascii'), np.uint8).reshape(len(lines), width)
+    return np.frombuffer(text.encode('utf-32-le'), np.uint32).reshape(len(lines), width)
+
+def _isIn(a, chars): return np.isin(a, [ord(c) for c in chars])
+
+def _rowLists(code, nrows):
+    # Yield the junction cells of a code array as per-row (col, code)
+    # lists.  Rows are converted lazily, as _nodeCodes yields them, so
+    # that millions of tuples are not alive at once.
+    rr, cc = np.nonzero(code >= 0)
+    cols, codes = cc.tolist(), code[rr, cc].tolist()
+    a = 0
+    for b in np.cumsum(np.bincount(rr, minlength=nrows)).tolist():
+        yield list(zip(cols[a:b], codes[a:b]))
+        a = b
+
+def _nodeCodesNumpy(padded, blank, rows):
+    if not rows: return []
+    cur = _charArray([padded[r] for r in rows], len(blank))
+    up  = _charArray([padded[r-1] if r else blank for r in rows], len(blank))
+    upL, upR, left = np.roll(up, 1, 1), np.roll(up, -1, 1), np.roll(cur, 1, 1)
+    slash, back, hashes = cur == ord('/'), cur == ord('\\'), cur == ord('#')
+    code = np.full(cur.shape, -1, np.int8)
+    code[cur == ord('X')] = XM
+    code[hashes] = HM
+    code[hashes & (left == ord('#'))] = HX
+    code[slash & (upR == ord('_'))] = UL
+    code[slash & _isIn(up, '|#\\')] = LR
+    code[back & (upL == ord('_'))] = UR
+    code[back & _isIn(up, '|#/')] = LL
+    return _rowLists(code, len(rows))
+
+def _progCodesNumpy(g, padded, blank):
+    if not padded: return []
+    grid = _charArray([blank] + padded + [blank], len(blank))
+    up, cur, down = grid[:-2], grid[1:-1], grid[2:]
+    upL, upR = np.roll(up, 1, 1), np.roll(up, -1, 1)
+    slash, back, bar = cur == ord('/'), cur == ord('\\'), cur == ord('|')
+    downBar = down == ord('|')
+    code = np.full(cur.shape, -1, np.int8)
+    code[bar & ~downBar] = VL
+    code[slash & (upR == ord('_'))] = UL
+    code[slash & downBar] = UR
+    code[slash & _isIn(up, '|\\')] = LR
+    code[back & (upL == ord('_'))] = UR
+    code[back & downBar] = UL
+    code[back & _isIn(up, '|/')] = LL
+    # Text characters are anything that's not an edge character or space
+    rr, cc = np.nonzero(~_isIn(cur, '|/\\_ \t\n'))
+    g.text_chars.extend(zip(rr.tolist(), cc.tolist(), map(chr, cur[rr, cc].tolist())))
+    return _rowLists(code, len(padded))
+#==============================================================
+def _unindex(index, col, row):  # Remove row from index[col]
+    rows = index[col]
+    del rows[bisect_left(rows, row)]
+
+def _firstFalse(flags):         # Index of the first false flag, else len
+    return next((i for i, f in enumerate(flags) if not f), len(flags))
+
+class IncrementalParser:
+    '''Keep a diagram section's grid between edits, and update it in
+    place when the section changes, for editors that regenerate on
+    every save.
+
+    update(idata) returns a Grid equal to parse(idata, style, engine).
+    Only changed lines, and the lines whose classification looks at
+    them, are reclassified.  Junctions on unchanged lines keep their
+    objects.  Links are redone only for junctions on changed lines, for
+    junctions above them in the same columns, and for the junctions
+    those link to.  If the number of lines changes, or an edit reaches
+    the first two lines, update() parses the whole section again.  The
+    first two lines matter because the line-ending junctions link there.
+    '''
+    def __init__(self, style='nodes', engine='auto'):
+        self.style, self.engine = style, engine
+        self.grid = None
+
+    def update(self, idata):
+        idata = list(idata)
+        g, n = self.grid, len(idata)
+        if g is None or n != g.maxy:
+            return self._reparse(idata)
+        old = g.idata
+        p = 0                   # First changed line
+        while p < n and idata[p] == old[p]: p += 1
+        if p == n:
+            g.idata = idata
+            return g
+        q = n                   # Lines from q on are unchanged
+        while idata[q-1] == old[q-1]: q -= 1
+        prog = self.style == 'progression'
+        # Classification looks one line up, and in 'progression' style
+        # one line down, so reclassify the neighbors of changed lines too
+        lo, hi = p - prog, min(q + 1, n)
+        if lo < 2:
+            return self._reparse(idata)
+        band = range(lo, hi)
+
+        # Classify the band's lines
+        near = range(lo - 1, min(hi + 1, n))
+        width = max(len(idata[r]) for r in near) + 2
+        padded, blank = {r: idata[r].ljust(width) for r in near}, ' ' * width
+        text, tchars = self.text[:], {}
+        if prog:
+            found = []
+            codes = dict(zip(band, _progCodes(idata, padded, blank, band, found)))
+            for row, col, ch in found:
+                tchars.setdefault(row, []).append((row, col, ch))
+        else:
+            labeled = self.style == 'labeled'
+            for r in band:
+                if labeled:
+                    labs = _lineLabels(idata[r])
+                    if labs: g.labels[r] = labs
+                    else: g.labels.pop(r, None)
+                text[r] = _isTextLine(idata[r], labeled)
+            rows = [r for r in band if not text[r]]
+            codes = dict(zip(rows, _nodeCodes(idata, padded, blank, rows)))
+        # In 'progression' style hhfind also reads the line's text
+        dirty = [r for r in band if text[r] != self.text[r] or (prog and idata[r] != old[r])
+                 or codes.get(r, []) != [(j.col, j.code) for j in self.js[r]]]
+        if dirty and min(_firstFalse(text), _firstFalse(self.text)) >= dirty[0]:
+            return self._reparse(idata)     # corners[0] could change
+        g.idata = idata
+        if prog:
+            for r in band: self.tchars[r] = tchars.get(r, [])
+            g.text_chars = list(chain.from_iterable(self.tchars))
+        else:
+            g.chars = [(r, l) for r, l in enumerate(idata) if text[r]]
+        if not dirty:
+            return g
+        self._relink(dirty, text, codes)
+        return g
+
+    def _relink(self, dirty, text, codes):
+        g, corners, vvset = self.grid, self.grid.corners, self._vvset
+        self._cache = {}        # Per-update lookups, made by _out
+        sentOld = self._sentTargets()
+        removed, added, touched = set(), [], {}     # touched: col -> dirty rows
+        for r in dirty:
+            # Drop the line's old junctions from the indexes
+            gone = self.js[r] + ([self.sent[r]] if self.sent[r] else [])
+            removed.update(gone)
+            for j in self.js[r]:
+                _unindex(self.allrows, j.col, r)
+                if j.code in vvset: _unindex(self.vvrows, j.col, r)
+                touched.setdefault(j.col, []).append(r)
+            # Make and index its new junctions
+            js, nodetab, xs = [], [], []
+            for col, code in codes.get(r, ()):
+                j = Junction(-1, r, col, code)
+                js.append(j)
+                if code == XM: xs.append(j)
+                elif code == HM: nodetab.append(Node(j))
+                elif code == HX: nodetab[-1].extend(j)
+                insort(self.allrows.setdefault(col, []), r)
+                if code in vvset: insort(self.vvrows.setdefault(col, []), r)
+                touched.setdefault(col, []).append(r)
+            self.js[r], self.cols[r] = js, [j.col for j in js]
+            self.nodetab[r], self.xs[r] = nodetab, xs
+            boxed = [j.col for j in js if j.code != 0]
+            self.box[r] = (min(boxed), max(boxed)) if boxed else None
+            if self.sent[r]: del self.sline[self.sent[r]]
+            self.sent[r] = None if text[r] else Junction(0,0,0,0)
+            if self.sent[r]: self.sline[self.sent[r]] = r
+            added += js
+            if self.sent[r]: added.append(self.sent[r])
+        self.text = text
+
+        # Splice the new junctions into corners and renumber
+        a, b = self.start[dirty[0]], self._end(dirty[-1], removed)
+        seg = []
+        for r in range(dirty[0], dirty[-1] + 1):
+            seg += self.js[r]
+            if self.sent[r]: seg.append(self.sent[r])
+        corners[a:b] = seg
+        renum = len(corners) if len(seg) != b - a else a + len(seg)
+        for i in range(a, renum):
+            j = corners[i]
+            if j.num: j.num = i     # Line-ending junctions stay number 0
+        pos = self.start[dirty[0]]
+        for r in range(dirty[0], len(self.js)):
+            self.start[r] = pos
+            pos += len(self.js[r]) + (self.sent[r] is not None)
+
+        # Junctions whose links may have changed: those just made, and
+        # those above a changed line in the same column, from the last
+        # junction there that vvfind can stop at
+        cand = set(added)
+        for col, rows in touched.items():
+            allrows, vv = self.allrows.get(col, []), self.vvrows.get(col, [])
+            k = bisect_left(vv, min(rows))
+            top = vv[k-1] if k else -1
+            for row in allrows[bisect_left(allrows, top):bisect_left(allrows, max(rows))]:
+                cand.add(self._at(row, col))
+        self._cache = {}
+        if self._sentTargets() != sentOld:
+            cand.update(self.sline)
+        # Junctions whose conn lists may have changed
+        outs, into, redo = {}, {}, set(cand)
+        for j in cand:
+            redo.update(j.conn)
+            outs[j] = o = self._out(j)
+            for t in o:
+                if t is not None:
+                    redo.add(t)
+                    into.setdefault(t, []).append(j)
+        for j in removed:
+            redo.update(j.conn)
+        redo -= removed
+        # Rebuild each one's conn in the order the full linking pass
+        # would make its links: by the position of the junction that
+        # asked for the link, then hhfind before vvfind
+        for x in redo:
+            when = {}
+            for s, t in enumerate(outs.get(x) or self._out(x)):
+                if t is not None and t not in when:
+                    when[t] = (self._pos(x), s)
+            for y in chain(x.conn, into.get(x, ())):
+                if y in removed: continue
+                for s, t in enumerate(outs.get(y) or self._out(y)):
+                    if t is x:
+                        key = (self._pos(y), s)
+                        if y not in when or key < when[y]: when[y] = key
+            x.conn = tuple(sorted(when, key=when.get))
+
+        # Rebuild the lists derived from the junctions
+        g.nodetab = list(chain.from_iterable(self.nodetab))
+        g.nodes = [j for nd in g.nodetab for j in nd.junctions]
+        g.owner = {hx.num: nd.hm for nd in g.nodetab for hx in nd.junctions[1:]}
+        g.xlist = list(chain.from_iterable(self.xs))
+        boxes = [b for b in self.box if b]
+        rows = [r for r, b in enumerate(self.box) if b]
+        g.bbox = (min(b[0] for b in boxes), max(b[1] for b in boxes),
+                  rows[0], rows[-1]) if boxes else None
+
+    def _end(self, r, removed):
+        # Position just past line r's junctions, before they were replaced
+        corners, i = self.grid.corners, self.start[r]
+        while i < len(corners) and corners[i] in removed: i += 1
+        return i
+
+    def _at(self, row, col):    # The junction at row, col
+        return self.js[row][bisect_left(self.cols[row], col)]
+
+    def _pos(self, j):          # Position of j in corners
+        r = self.sline.get(j)
+        return j.num if r is None else self.start[r] + len(self.js[r])
+
+    def _sentTargets(self):
+        # What the line-ending junctions link to (they all link alike)
+        if 'sent' not in self._cache:
+            self._cache['sent'] = self._out(Junction(0,0,0,0), True)
+        return self._cache['sent']
+
+    def _out(self, j, sentinel=False):
+        # (hhfind, vvfind) results for j, as the full linking pass finds them
+        corners, code, row, col = self.grid.corners, j.code, j.row, j.col
+        if not sentinel and j in self.sline:
+            return self._sentTargets()
+        hh = vv = None
+        if self.style == 'progression':
+            if code in (UL, LL, LR, UR):
+                if row not in self._cache:
+                    cors = [c for c in self.js[row] if c.num > 0 and c.code < CL]
+                    self._cache[row] = (cors, [c.col for c in cors]) + _progRow(self.grid.idata[row])
+                if self._cache[row][0]:
+                    hh = _progHH(j, *self._cache[row])
+            if code in (UL, UR, LR, LL, VL):
+                if sentinel:    # First junction after position 0 in column 0
+                    for r in range(len(self.js)):
+                        col0 = self.js[r][:1] if self.cols[r][:1] == [0] else []
+                        after = [c for c in col0 + [self.sent[r]] if c is not corners[0]]
+                        if after:
+                            vv = after[0] if after[0] not in self.sline else corners[0]
+                            break
+                elif col == 0:  # Next is this line's ending junction
+                    vv = corners[0]
+                else:
+                    rows = self.allrows[col]
+                    k = bisect_right(rows, row)
+                    vv = self._at(rows[k], col) if k < len(rows) else None
+        else:
+            if code in (UL, LL):
+                js = self.js[row]
+                for c in js[bisect_right(self.cols[row], col):]:
+                    if c.code in (UR, LR):
+                        hh = c; break
+                else:
+                    hh = corners[0] if row == 0 else None
+            if code in (UL, UR, HM, HX):
+                rows = self.vvrows.get(0 if sentinel else col, [])
+                k = 0 if sentinel else bisect_right(rows, row)
+                if k < len(rows):
+                    vv = self._at(rows[k], 0 if sentinel else col)
+                    if sentinel and vv is corners[0]:
+                        vv = self._at(rows[1], 0) if len(rows) > 1 else None
+        return hh, vv
+
+    def _reparse(self, idata):
+        # Parse afresh, and index the result by line and by column
+        g = self.grid = parse(idata, self.style, self.engine)
+        corners, n = g.corners, g.maxy
+        self.text = text = [False] * n
+        for r, _ in g.chars: text[r] = True
+        self._vvset = (UR, LR, UL, LL, VL) if self.style == 'progression' else (LL, LR, XM, HM, HX)
+        self.js, self.cols, self.sent = [[] for r in range(n)], [[] for r in range(n)], [None] * n
+        self.start, self.box, self.sline = [0] * n, [None] * n, {}
+        self.nodetab, self.xs = [[] for r in range(n)], [[] for r in range(n)]
+        self.tchars = [[] for r in range(n)]
+        self.allrows, self.vvrows, self._cache = {}, {}, {}
+        # Line-ending junctions are number 0; at position 0, tell one from
+        # a real junction by counting the others
+        nsent = sum(1 for i in range(1, len(corners)) if corners[corners[i].num] is not corners[i])
+        firstSent = nsent < n - len(g.chars)
+        i = 0
+        for r in range(n):
+            self.start[r] = i
+            if text[r]: continue
+            while not (firstSent if i == 0 else corners[corners[i].num] is not corners[i]):
+                j = corners[i]
+                self.js[r].append(j)
+                self.allrows.setdefault(j.col, []).append(r)
+                if j.code in self._vvset: self.vvrows.setdefault(j.col, []).append(r)
+                i += 1
+            self.sent[r] = corners[i]
+            self.sline[corners[i]] = r
+            i += 1
+            self.cols[r] = [j.col for j in self.js[r]]
+            boxed = [j.col for j in self.js[r] if j.code != 0]
+            self.box[r] = (min(boxed), max(boxed)) if boxed else None
+        for nd in g.nodetab: self.nodetab[nd.row].append(nd)
+        for x in g.xlist: self.xs[x.row].append(x)
+        for t in g.text_chars: self.tchars[t[0]].append(t)
+        return g
@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+# -*- mode: python -*-
+
+# Streaming reader for drawNodes input files, shared by the main()s of
+# drawNodes, drawNodesLabeled and drawProgression.
+
+# An input file holds diagram sections.  A section opens with a line
+# starting with = (the rest of that line names the output file) and
+# closes with a line that is just =.  @name=value lines within a
+# section set directives for it; @ lines before the first section set
+# global directives, which every section inherits.  Lines outside
+# sections are otherwise ignored, as is a section that never closes.
+
+import fnmatch, hashlib, io, json, mmap, os, sys
+try:
+    from .sinks import write_atomic
+except ImportError:             # Run as a script rather than from the package
+    from sinks import write_atomic
+
+class Section:
+    '''One diagram section of an input file.
+
+    name        output file name, from the opening = line
+    lines       diagram lines, with ending whitespace dropped
+    directives  name -> value, from this section's @ lines
+    globals     name -> value, from @ lines before the first section
+    '''
+    def __init__(self, name, lines, directives, globals):
+        self.name, self.lines = name, lines
+        self.directives, self.globals = directives, globals
+    def get(self, name, default=None):
+        # Value of directive name: the section's own, else the global one
+        if name in self.directives:
+            return self.directives[name]
+        return self.globals.get(name, default)
+    def __repr__(self):
+        return f'Section({self.name!r}, {len(self.lines)} lines, {self.directives}, {self.globals})'
+
+def _numbers(a, val, n, kind, where):
+    # n comma-separated numbers of type kind, else None
+    parts = val.split(',')
+    if len(parts) == n:
+        try:
+            return tuple(kind(p) for p in parts)
+        except ValueError:
+            print(f"Warning: Invalid {where} format: {a}")
+
+def _imgsize(a, val, where): return _numbers(a, val, 2, int, where+'imgsize')
+def _camera(a, val, where):  return _numbers(a, val, 3, float, where+'camera')
+def _border(a, val, where):
+    try:
+        return float(val)
+    except ValueError:
+        print(f"Warning: Invalid {where}border format: {a}")
+def _colors(a, val, where):
+    # Parse @colors=Red,Blue,Green,#FF00FF,...
+    try:
+        color_string = val.strip()
+        if color_string:
+            return [c.strip() for c in color_string.split(',')]
+    except Exception as e:
+        print(f"Warning: Invalid {where}colors format: {a} - {e}")
+
+# Directive name -> parser returning its value, or None if invalid
+DIRECTIVES = {'imgsize': _imgsize, 'camera': _camera, 'border': _border, 'colors': _colors}
+
+def read_sections(fin, directives=tuple(DIRECTIVES), use_globals=True, globals=None):
+    '''Yield a Section for each diagram section read from fin, any
+    iterable of lines, in a single pass: only the current section's
+    lines are held at once, and fin is never seeked.
+
+    directives names the @ directives to recognize; other @ lines in a
+    section are diagram lines.  Invalid directive values are reported
+    and ignored.  If use_globals is false, @ lines before the first
+    section are ignored too.  If globals is given, sections inherit it
+    instead of reading globals from fin.'''
+    started = globals is not None
+    globals, lines = globals or {}, None
+    for a in fin:
+        if lines is None:           # Outside of any section
+            if a[:1] == '=':        # Detect opening =
+                name, lines, own, started = a[1:].rstrip(), [], {}, True
+            elif use_globals and not started:
+                _directive(a.rstrip(), directives, globals, False)
+            continue
+        a = a.rstrip()              # Drop ending whitespace
+        if a == '=':                # Detect closing =
+            yield Section(name, lines, own, globals)
+            lines = None
+        elif not _directive(a, directives, own, True):
+            lines.append(a)
+
+def _directive(a, directives, into, section):
+    # If a is an @name=value line for one of directives, store its value
+    # in into, unless invalid, and return True
+    if a[:1] != '@' or '=' not in a:
+        return False
+    name, val = a[1:].split('=', 1)
+    if name not in directives:
+        return False
+    value = DIRECTIVES[name](a, val, '' if section else 'global ')
+    if value is not None or (section and name == 'colors'):
+        into[name] = value      # In a section, an empty @colors= cancels colors
+    return True
+#==============================================================
+# Section index.  A sidecar file, named as the input file plus
+# INDEX_SUFFIX, maps each section's name to the byte range of its
+# lines (from its opening = line through its closing =) and a hash of
+# those bytes.  It is rebuilt whenever the input file's size or
+# modification time differs from what the index records.
+INDEX_SUFFIX = '.idx'
+
+def scan_sections(path):
+    '''Return the index of input file path: a dict with its size,
+    mtime_ns, prefix (bytes before the first section, which hold the
+    global directives) and sections, a list of [name, start, end,
+    sha256] in file order.'''
+    st = os.stat(path)
+    index = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'prefix': 0, 'sections': []}
+    if not st.st_size:
+        return index
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        def next_line(i):       # Start of the next line starting with =, or -1
+            i = m.find(b'\n=', i)
+            return i + 1 if i >= 0 else -1
+        # Only lines starting with = matter, so jump from one to the next
+        pos, start, first = 0 if m[:1] == b'=' else next_line(0), None, None
+        while pos >= 0:
+            end = m.find(b'\n', pos) + 1 or st.st_size
+            if start is None:           # Opening =
+                start, name = pos, m[pos+1:end].decode().rstrip()
+                if first is None: first = pos
+            elif m[pos:end].decode().rstrip() == '=':     # Closing =
+                digest = hashlib.sha256(m[start:end]).hexdigest()
+                index['sections'].append([name, start, end, digest])
+                start = None
+            pos = next_line(end - 1)
+    index['prefix'] = st.st_size if first is None else first
+    return index
+
+def load_index(path):
+    '''Return the index of input file path, from its sidecar file if
+    that is current, else from a fresh scan, which is then saved as the
+    sidecar if possible.'''
+    st, side = os.stat(path), path + INDEX_SUFFIX
+    try:
+        with open(side) as f:
+            index = json.load(f)
+        if (index['size'], index['mtime_ns']) == (st.st_size, st.st_mtime_ns):
+            return index
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    index = scan_sections(path)
+    try:
+        write_atomic(side, json.dumps(index).encode())
+    except OSError:
+        pass                    # Eg, a read-only directory; just don't keep it
+    return index
+
+def input_sections(path, only=None, directives=tuple(DIRECTIVES), use_globals=True, shard=None,
+                   costs=None):
+    '''Yield the Sections of input file path, as read_sections() does;
+    path '-' means stdin.  If only is given, as a comma-separated list
+    of names or glob patterns, yield just the sections whose names
+    match; if shard is given, as (i, n) (see parse_shard()), just those
+    of shard i of n (see shard_names()).  If costs is given, a function
+    of a dict of section names to sizes in bytes returning a dict of
+    their expected costs (eg, costs.CostModel.section_costs), yield the
+    sections costliest first, those of the same name in file order.  In
+    any of these cases, each is read directly at its offset from the
+    file's index.  (stdin can't be indexed, so it is read through
+    regardless, in order, and sharded by name alone.)'''
+    patterns = _patterns(only)
+    if path == '-':
+        for sec in read_sections(sys.stdin, directives, use_globals):
+            if (not patterns or _matches(sec.name, patterns)) and \
+               (not shard or _rank(sec.name, shard[1])[0] == shard[0] - 1):
+                yield sec
+        return
+    if not patterns and not shard and not costs:
+        with open(path) as fin:
+            yield from read_sections(fin, directives, use_globals)
+        return
+    index = load_index(path)
+    with open(path, 'rb') as f:
+        def text(start, end):   # Lines of bytes start..end, as text mode reads them
+            f.seek(start)
+            return io.StringIO(f.read(end - start).decode(), newline=None)
+        globals = read_globals(text(0, index['prefix']), directives) if use_globals else {}
+        entries = list(selected(index, only, shard))
+        if costs:
+            entries = _costliest_first(entries, costs)
+        for name, start, end, digest in entries:
+            yield from read_sections(text(start, end), directives, globals=globals)
+
+def _costliest_first(entries, costs):
+    # Index entries, ordered by expected cost of their names, by costs();
+    # sections of the same name (later ones overwrite earlier ones' files)
+    # stay in file order, together
+    sizes = {}
+    for name, start, end, digest in entries:
+        sizes[name] = sizes.get(name, 0) + end - start
+    cost = costs(sizes)
+    rank = {name: i for i, name in enumerate(sorted(sizes, key=lambda name: -cost[name]))}
+    return sorted(entries, key=lambda entry: rank[entry[0]])
+
+def selected(index, only=None, shard=None):
+    '''Yield the [name, start, end, sha256] entries of index (from
+    load_index()) for the sections input_sections() reads, given only
+    and shard.'''
+    patterns = _patterns(only)
+    names = shard_names(index, *shard) if shard else None
+    for entry in index['sections']:
+        if (not patterns or _matches(entry[0], patterns)) and (names is None or entry[0] in names):
+            yield entry
+
+def section_names(path):
+    '''Return a list of the names of the sections of input file path,
+    in file order, without repeats; None for stdin.'''
+    if path == '-':
+        return None
+    return list(dict.fromkeys(name for name, *range in load_index(path)['sections']))
+
+def _patterns(only):
+    # Names or glob patterns of only option value only, a comma-separated list
+    return [p.strip() for p in (only or '').split(',') if p.strip()]
+
+def _matches(name, patterns):
+    return any(fnmatch.fnmatchcase(name, p) for p in patterns)
+
+def read_globals(fin, directives=tuple(DIRECTIVES)):
+    # Global directives, from lines of fin before the first section
+    globals = {}
+    for a in fin:
+        if a[:1] == '=': break
+        _directive(a.rstrip(), directives, globals, False)
+    return globals
+#==============================================================
+# Sharding, to split an input file's sections among n runs (eg, on n
+# machines), which together process each section just once.  Each run
+# works out the same split from the file's index, without consulting
+# the others.
+SHARD_SLACK = 1.05              # Most a shard may exceed its share of the total size
+
+def parse_shard(value):
+    '''Return (i, n) for shard option value value, 'i/n' with
+    1 <= i <= n, or None if value is empty.'''
+    if not value:
+        return None
+    try:
+        i, n = (int(v) for v in value.split('/'))
+        if 1 <= i <= n:
+            return i, n
+    except ValueError:
+        pass
+    raise ValueError(f'shard should be i/n, with 1 <= i <= n: {value}')
+
+def shard_names(index, i, n):
+    '''Return the set of the names of the sections in index (from
+    load_index()) that are shard i of n.  Sections of the same name
+    (later ones overwrite earlier ones' files) go together, weighted by
+    their total size in bytes.  Largest first, each goes to the first
+    shard, in an order given by a hash of its name, that it fits in
+    without going over SHARD_SLACK times an even share of the total
+    size; else to the least full.  So shards are near equal in size,
+    and a section stays in the same shard while sizes change little.'''
+    sizes = {}
+    for name, start, end, digest in index['sections']:
+        sizes[name] = sizes.get(name, 0) + end - start
+    room = SHARD_SLACK * sum(sizes.values()) / n
+    loads, names = [0] * n, set()
+    for name in sorted(sizes, key=lambda name: (-sizes[name], name)):
+        size = sizes[name]
+        to = next((s for s in _rank(name, n) if loads[s] + size <= room),
+                  min(range(n), key=loads.__getitem__))
+        loads[to] += size
+        if to == i - 1:
+            names.add(name)
+    return names
+
+def _rank(name, n):
+    # Shards 0..n-1, in an order that depends only on name and n
+    def weight(s):
+        return hashlib.sha256(f'{s}/{n}/{name}'.encode()).digest()
+    return sorted(range(n), key=weight)
@@ -0,0 +1,596 @@
+#!/usr/bin/env python3
+# -*- mode: python -*-
+
+# Output sinks for drawNodes, drawNodesLabeled and drawProgression.
+# process() opens each output file it writes through a sink, by name,
+# as a text file; the sink decides where the text goes: to files in a
+# directory, or into one tar or zip archive.  An archive ends with a
+# manifest member, MANIFEST, listing the files of each diagram; Bundle
+# reads archives back.
+
+import contextlib, hashlib, io, itertools, json, os, re, shutil, sys, tarfile, tempfile, threading, time, zipfile
+try:
+    import fcntl
+except ImportError:             # Eg, on Windows; then there's no locking
+    fcntl = None
+try:
+    from .batch import run_steps
+except ImportError:             # Run as a script rather than from the package
+    from batch import run_steps
+
+MANIFEST = 'MANIFEST.json'
+STAMP_SUFFIX = '.stamp'         # Render-parameter stamps, eg fig3.png.stamp
+STABLE_TIME = 315532800         # Member mtime in stable archives, 1980-01-01
+LOCK_FILE = '.drawnodes.lock'   # Per-diagram render locks, in an output directory
+# The time in a heading's first line, which stamps leave out
+_HEADING_TIME = re.compile(rb'\A(// File [^\n]*, generated) \d{4}-\d\d-\d\d  \d\d:\d\d:\d\d')
+JOURNAL_FILE = '.drawnodes.journal'     # Sections finished, in an output directory
+
+# Options that choose which sections a run does, or how, but don't
+# change their outputs; the journal ignores them
+RUN_OPTIONS = {'file', 'only', 'out', 'jobs', 'renders', 'posts', 'shard',
+               'merge', 'enqueue', 'work', 'lease', 'resume', 'journal'}
+
+_lockfd_lock = threading.Lock()
+_tracking = threading.Lock()    # Guards FileSinks' sections (a sink's own lock wouldn't pickle)
+
+def _umask():
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+UMASK = _umask()
+
+def write_atomic(path, data):
+    '''Write bytes data to file path by way of a temporary file in the
+    same directory, renamed into place.'''
+    dir, base = os.path.split(path)
+    fd, tmp = tempfile.mkstemp(prefix=f'.{base}.', suffix='.tmp', dir=dir or '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.chmod(tmp, 0o666 & ~UMASK)   # As open() would make it
+        os.replace(tmp, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.unlink(tmp)
+        raise
+
+def temp_path(path, ext):
+    # Name for a temporary file beside path, hidden, ending in ext
+    dir, base = os.path.split(path)
+    return os.path.join(dir, f'.{base}.{os.getpid()}.{next(_temps)}.tmp{ext}')
+_temps = itertools.count()
+
+class FileSink:
+    '''Write each output file to its name, in directory dir.  Each file
+    is written whole to a temporary file beside it, then renamed into
+    place, so a reader (eg OpenSCAD's automatic reload) sees either the
+    old file or the new one.  If stable, headings leave out the time,
+    and a file is rewritten only when its content differs, so unchanged
+    files keep their mtimes.  make() renders files in the background
+    if pool (a batch.Pipeline with render stages) is given, or leaves
+    them to the main process's sink if defer is true.  If journal is
+    true, sections that finish() are recorded in a Journal in dir.  If
+    shard is given, as (i, n), close() writes MANIFEST in dir, listing
+    the files written, as an archive's manifest does, for merge_shards().'''
+    def __init__(self, dir='.', stable=False, pool=None, defer=False, journal=False, shard=None):
+        self.dir, self.stable, self.pool, self.defer = dir, stable, pool, defer
+        self.shard, self.written = shard, set()
+        self.lockfd, self.deferred, self.started = None, [], time.time()
+        self.failed = []        # Names of files whose make() failed
+        self.journal = Journal(dir) if journal else None
+        self.sections = {}      # Diagram -> _Progress of its section, until journaled
+    def path(self, name):
+        return os.path.join(self.dir, name)
+    def open(self, name):
+        return _Member(self, name)
+    def add(self, name, data):
+        # Write data to file name, unless stable and that holds data already
+        self._note(name)
+        path = self.path(name)
+        if self.stable:
+            try:
+                if os.path.getsize(path) == len(data):
+                    with open(path, 'rb') as f:
+                        if f.read() == data:
+                            return
+            except OSError:
+                pass
+        write_atomic(path, data)
+    def fresh(self, name, inputs, params):
+        '''True if file name exists, and its stamp file says it was made
+        from input files inputs, as they are now (but for the times in
+        their headings), with render parameters params (a JSON-able
+        list); and, unless stable, that it was made since this sink was
+        created, ie by another run going on at the same time.'''
+        stamp = self.path(name) + STAMP_SUFFIX
+        if not os.path.exists(self.path(name)):
+            return False
+        try:
+            with open(stamp) as f:
+                return f.read() == self._key(inputs, params) and \
+                    (self.stable or os.stat(stamp).st_mtime >= self.started)
+        except OSError:
+            return False
+    def stamp(self, name, inputs, params):
+        # Record for fresh() that file name was made from inputs, params;
+        # if that fails (eg, an input was removed meanwhile), it is just
+        # made again next time
+        with contextlib.suppress(OSError):
+            write_atomic(self.path(name) + STAMP_SUFFIX, self._key(inputs, params).encode())
+    def _key(self, inputs, params):
+        h = hashlib.sha256(json.dumps(params).encode())
+        for name in inputs:
+            with open(self.path(name), 'rb') as f:
+                h.update(hashlib.sha256(_HEADING_TIME.sub(rb'\1', f.read(), 1)).digest())
+        return h.hexdigest() + '\n'
+    def make(self, name, inputs, params, render):
+        '''Make file name from input files inputs with render parameters
+        params, by calling render(dir=..., log=..., timeout=...), which
+        returns a generator that writes it into directory dir, prints
+        messages to file log, allows openscad timeout seconds (None for
+        its default), and has the value True if it succeeds (see
+        batch.Pipeline.submit()); but skip that if name is fresh().
+        While making name, hold an advisory lock on it, so that runs
+        writing to the same directory at once take turns, and a run
+        that waited then finds the other's file fresh.'''
+        if self.defer:
+            self.deferred.append((name, inputs, params, render))
+            return
+        def job(log, timeout=None):
+            with self.lock(diagram_of(name)):
+                if self.fresh(name, inputs, params):
+                    print(f'{name} is up to date', file=log)
+                    return True
+                done = yield from render(dir=self.dir, log=log, timeout=timeout)
+                if done:
+                    self.stamp(name, inputs, params)
+                return done
+        if self.pool:
+            self._note(name, renders=1)
+            self.pool.submit(name, job, [self.path(n) for n in inputs],
+                             lambda ok: self._made(name, ok, -1))
+        else:
+            self._made(name, run_steps(job(sys.stdout)))
+    def _made(self, name, ok, renders=0):
+        # Note file name as made, successfully if ok, else as failed
+        if not ok:
+            with _tracking:
+                self.failed.append(name)
+        self._note(name, renders, ok)
+    def _note(self, name, renders=0, ok=True):
+        # Note file name as written, or (if renders is 1) as being made,
+        # or (if -1) as made, successfully if ok
+        with _tracking:
+            if self.shard:
+                self.written.add(name)
+            progress = self.sections.setdefault(diagram_of(name), _Progress())
+            progress.files.add(name)
+            progress.renders += renders
+            progress.ok = progress.ok and bool(ok)
+            self._settle(diagram_of(name))
+    def finished(self, sec, options):
+        # True if the journal says Section sec, drawn with options, was
+        # finished by some run, and its outputs are still as it left them
+        return bool(self.journal) and self.journal.finished(sec.name, self.journal.key(sec, options))
+    def finish(self, sec, options):
+        '''Note that the work on Section sec, drawn with options, is
+        done, but for any renders still under way.  Once those are done
+        too, if every file was written and made successfully, the section
+        is journaled.'''
+        with _tracking:
+            progress = self.sections.setdefault(sec.name, _Progress())
+            progress.key = self.journal.key(sec, options) if self.journal else True
+            self._settle(sec.name)
+    def _settle(self, diagram):
+        # (With _tracking held) journal diagram's section if finished
+        progress = self.sections[diagram]
+        if progress.key and not progress.renders:
+            del self.sections[diagram]
+            if progress.ok and self.journal:
+                self.journal.record(diagram, progress.key, progress.files)
+    @contextlib.contextmanager
+    def lock(self, name):
+        # Lock one byte of the lock file, at an offset from name's hash
+        if fcntl is None:
+            yield
+            return
+        with _lockfd_lock:      # Two fds would share, and drop, locks
+            if self.lockfd is None:
+                self.lockfd = os.open(self.path(LOCK_FILE), os.O_RDWR | os.O_CREAT, 0o666)
+        at = int.from_bytes(hashlib.sha256(name.encode()).digest()[:4], 'big') >> 1
+        fcntl.lockf(self.lockfd, fcntl.LOCK_EX, 1, at)
+        try:
+            yield
+        finally:
+            fcntl.lockf(self.lockfd, fcntl.LOCK_UN, 1, at)
+    @contextlib.contextmanager
+    def staging(self, name, files):
+        # Files are written in place, in dir
+        yield self
+    def close(self):
+        if self.pool:
+            self.pool.close()   # Wait for renders
+        if self.lockfd is not None:
+            os.close(self.lockfd)
+            self.lockfd = None
+        if self.shard:
+            files = []
+            for name in sorted(self.written):
+                data = _read(self.path(name))
+                if data is not None:    # Else its render failed
+                    files.append({'name': name, 'diagram': diagram_of(name),
+                                  'size': len(data), 'sha256': hashlib.sha256(data).hexdigest()})
+            manifest = {'format': 1, 'files': files, 'shard': '%d/%d' % self.shard}
+            write_atomic(self.path(MANIFEST), json.dumps(manifest, indent=1).encode())
+    def worker(self):
+        # A sink like this one, for use in a worker process
+        sink = FileSink(self.dir, self.stable, defer=self.pool is not None)
+        sink.started = self.started
+        return sink
+    def handoff(self):
+        # In a worker process, when done: files are written already,
+        # except any to make in the main process; hand those over, and
+        # what was written and whether it succeeded
+        self.close()
+        return self.deferred, [(d, p.files, p.ok) for d, p in self.sections.items()], self.failed
+    def merge(self, outputs):
+        deferred, sections, failed = outputs
+        self.failed += failed
+        for diagram, files, ok in sections:
+            for name in files:
+                self._note(name, ok=ok)
+        for args in deferred:
+            self.make(*args)
+
+class _Progress:
+    # What's known of a section's outputs: files written or being made,
+    # how many are being made, whether all succeeded so far, and its
+    # journal key, once its work is done
+    def __init__(self):
+        self.files, self.renders, self.ok, self.key = set(), 0, True, None
+
+class Journal:
+    '''Append-only record, in JOURNAL_FILE in directory dir, of the
+    sections that runs writing there finished: a JSON line for each,
+    with its name, a hash of its text, a hash of the options it was
+    drawn with (but RUN_OPTIONS), and the hashes of its output files.
+    A run that dies partway, eg in an openscad crash, leaves a record of
+    what it finished, so a rerun with the resume option can skip those.'''
+    def __init__(self, dir):
+        self.dir, self.entries, self.ends = dir, None, False
+        self.path = os.path.join(dir, JOURNAL_FILE)
+    def key(self, sec, options):
+        # [text hash, options hash] of Section sec, drawn with options
+        text = json.dumps([sec.name, sec.lines, sec.directives, sec.globals])
+        opts = json.dumps({k: v for k, v in sorted(options.items()) if k not in RUN_OPTIONS})
+        return [hashlib.sha256(text.encode()).hexdigest(), hashlib.sha256(opts.encode()).hexdigest()]
+    def finished(self, name, key):
+        '''True if the last record of section name has key, and its output
+        files still have the hashes recorded.'''
+        if self.entries is None:
+            self.entries = self._load()
+        e = self.entries.get(name)
+        if not e or [e['input'], e['options']] != key or not e['outputs']:
+            return False
+        return all(_hash(os.path.join(self.dir, f)) == h for f, h in e['outputs'].items())
+    def record(self, name, key, files):
+        # Append a record of section name, with key, that wrote files
+        outputs = {f: _hash(os.path.join(self.dir, f)) for f in sorted(files)}
+        if None in outputs.values():
+            return              # Removed meanwhile; don't count it finished
+        line = json.dumps({'name': name, 'input': key[0], 'options': key[1],
+                           'outputs': outputs, 'time': int(time.time())})
+        with open(self.path, 'a+b') as f:
+            if not self.ends:   # After a run died mid-line, start a new line
+                f.seek(0, os.SEEK_END)
+                if f.tell():
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b'\n':
+                        line = '\n' + line
+                self.ends = True
+            f.write((line + '\n').encode())    # One write, appended whole
+    def _load(self):
+        # Name -> its last record; if many are out of date, rewrite the
+        # file with just the latest
+        entries, lines = {}, 0
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    lines += 1
+                    try:
+                        e = json.loads(line)
+                        entries[e['name']] = e
+                    except (ValueError, KeyError, TypeError):
+                        pass    # Cut short by a crash
+        except OSError:
+            pass
+        if lines > 2*len(entries) + 1000:
+            data = ''.join(json.dumps(e) + '\n' for e in entries.values())
+            with contextlib.suppress(OSError):
+                write_atomic(self.path, data.encode())
+        return entries
+
+def _hash(path):
+    # sha256 of file path's content, or None if it can't be read
+    data = _read(path)
+    return None if data is None else hashlib.sha256(data).hexdigest()
+
+def _read(path):
+    # Content of file path, or None if it can't be read
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except OSError:
+        return None
+
+class _Scratch(FileSink):
+    # Staging directory of an archive sink, whose files are all new,
+    # and which no other run uses
+    def fresh(self, name, inputs, params):
+        return False
+    def stamp(self, name, inputs, params):
+        pass
+    def lock(self, name):
+        return contextlib.nullcontext()
+
+class _Member(io.StringIO):
+    # Text of one archive member; added to the archive when closed
+    def __init__(self, sink, name):
+        super().__init__()
+        self.sink, self.name = sink, name
+    def close(self):
+        if not self.closed:
+            self.sink.add(self.name, self.getvalue().encode())
+        super().close()
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            super().close()     # Drop a partly written file
+
+class ArchiveSink:
+    '''Base for sinks that write output files as members of one
+    archive on binary file fileobj, closing fileobj at the end if owns
+    is true.  If stable, headings leave out the time, and members get a
+    fixed mtime, so the archive depends only on its input.  shard, if
+    given as (i, n), is recorded in the manifest as 'i/n', for
+    merge_shards().
+    Subclasses supply _write(name, data) and _finish().'''
+    def __init__(self, fileobj, owns=False, stable=False, shard=None):
+        self.fileobj, self.owns, self.stable, self.manifest = fileobj, owns, stable, []
+        self.shard, self.failed = shard, []     # As for FileSink
+    def mtime(self):
+        return STABLE_TIME if self.stable else int(time.time())
+    def open(self, name):
+        return _Member(self, name)
+    def add(self, name, data):
+        self._write(name, data)
+        self.manifest.append({'name': name, 'diagram': diagram_of(name),
+                              'size': len(data), 'sha256': hashlib.sha256(data).hexdigest()})
+    @contextlib.contextmanager
+    def staging(self, name, files):
+        '''Context for writing diagram name's outputs.  If files is true
+        (eg, to run openscad on them) it yields a FileSink on a scratch
+        directory, whose files are added to the archive, in name order,
+        on exit; else it yields this sink.'''
+        if not files:
+            yield self
+            return
+        scratch = tempfile.mkdtemp(prefix='drawnodes-')
+        try:
+            stage = _Scratch(scratch, self.stable)
+            yield stage
+            self.failed += stage.failed
+            for file in sorted(os.listdir(scratch)):
+                with open(os.path.join(scratch, file), 'rb') as f:
+                    self.add(file, f.read())
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+    def close(self):
+        manifest = {'format': 1, 'files': self.manifest}
+        if self.shard:
+            manifest['shard'] = '%d/%d' % self.shard
+        self._write(MANIFEST, json.dumps(manifest, indent=1).encode())
+        self._finish()
+        if self.owns:
+            self.fileobj.close()
+    def finished(self, sec, options):
+        return False            # An archive is written afresh each run
+    def finish(self, sec, options):
+        pass
+    def worker(self):
+        # A sink collecting members, for use in a worker process
+        return _Collector(self.stable)
+    def merge(self, outputs):
+        # Add members from a worker's _Collector
+        members, failed = outputs
+        self.failed += failed
+        for name, data in members:
+            self.add(name, data)
+
+class _Collector(ArchiveSink):
+    # Members a worker process wrote, to hand off to an ArchiveSink
+    def __init__(self, stable):
+        super().__init__(None, False, stable)
+        self.members = []
+    def _write(self, name, data):
+        self.members.append((name, data))
+    def handoff(self):
+        return self.members, self.failed
+
+class TarSink(ArchiveSink):
+    '''Write output files as members of a tar stream on fileobj, eg
+    sys.stdout.buffer.  Each member is written and flushed as soon as
+    it is closed, and fileobj is never seeked, so a reader at the other
+    end of a pipe gets each file as it is done.'''
+    def __init__(self, fileobj, owns=False, stable=False, shard=None):
+        super().__init__(fileobj, owns, stable, shard)
+        self.offset = 0
+    def _put(self, b):
+        self.fileobj.write(b)
+        self.offset += len(b)
+    def _write(self, name, data):
+        # tarfile's own stream mode holds back the last block written,
+        # so write headers and padding directly
+        info = tarfile.TarInfo(name)
+        info.size, info.mtime, info.mode = len(data), self.mtime(), 0o644
+        self._put(info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape'))
+        self._put(data + tarfile.NUL * (-len(data) % tarfile.BLOCKSIZE))
+        self.fileobj.flush()
+    def _finish(self):
+        # End-of-archive blocks, padded out to a whole record
+        end = self.offset + 2*tarfile.BLOCKSIZE
+        self._put(tarfile.NUL * (end - self.offset + -end % tarfile.RECORDSIZE))
+        self.fileobj.flush()
+
+class ZipSink(ArchiveSink):
+    '''Write output files as members of a zip archive on fileobj,
+    deflating all but PNGs, which are compressed already.'''
+    def __init__(self, fileobj, owns=False, stable=False, shard=None):
+        super().__init__(fileobj, owns, stable, shard)
+        self.zip = zipfile.ZipFile(fileobj, 'w')
+    def _write(self, name, data):
+        info = zipfile.ZipInfo(name, (time.gmtime if self.stable else time.localtime)(self.mtime())[:6])
+        info.compress_type = zipfile.ZIP_STORED if name.endswith('.png') else zipfile.ZIP_DEFLATED
+        info.external_attr = 0o644 << 16
+        self.zip.writestr(info, data)
+    def _finish(self):
+        self.zip.close()
+
+def diagram_of(name):
+    # Diagram that output file name belongs to: name less its extension
+    return name.rsplit('.', 1)[0]
+
+def open_sink(out, stable=False, pipeline=None, shard=None, journal=False):
+    '''Return the sink for out option value out: '-' for a tar stream
+    on stdout; a name ending in .tar or .zip for an archive of that
+    name; '' for files in the current directory, rendered in the render
+    stages of batch.Pipeline pipeline, if it has them.  stable, shard
+    and journal are as for FileSink and ArchiveSink.  Raises ValueError
+    for any other out.'''
+    if out and out != '-' and not out.endswith(('.tar', '.zip')):
+        raise ValueError(f'out should be -, or a name ending in .tar or .zip: {out}')
+    if out == '-':
+        return TarSink(sys.stdout.buffer, stable=stable, shard=shard)
+    if out.endswith('.tar'):
+        return TarSink(open(out, 'wb'), True, stable, shard)
+    if out.endswith('.zip'):
+        return ZipSink(open(out, 'wb'), True, stable, shard)
+    return FileSink(stable=stable, pool=pipeline if pipeline and pipeline.renders else None,
+                    journal=journal, shard=shard)
+
+def message_stream(out):
+    '''Return a context manager for main() loops: with out option value
+    '-', stdout carries the tar stream, so it sends prints to stderr.'''
+    if out == '-':
+        return contextlib.redirect_stdout(sys.stderr)
+    return contextlib.nullcontext()
+#==============================================================
+class Bundle:
+    '''Read back an archive written by a TarSink or ZipSink, eg
+
+        b = Bundle('bundle.zip')
+        b.diagrams()            # Names of the diagrams in it
+        b.read('fig3')          # {'fig3.scad': b'...', 'fig3.png': b'...'}
+        b.extract('fig3', 'out')
+
+    A zip archive is read by way of its central directory, a tar
+    archive by its member headers, skipping over member data; either
+    way just the wanted diagram's files are read.'''
+    def __init__(self, path):
+        if zipfile.is_zipfile(path):
+            self.zip, self.tar = zipfile.ZipFile(path), None
+        else:
+            self.zip, self.tar = None, tarfile.open(path)
+        self.manifest = json.loads(self._member(MANIFEST))
+        self.files = {}         # Diagram name -> list of its manifest entries
+        for e in self.manifest['files']:
+            self.files.setdefault(e['diagram'], []).append(e)
+    def _member(self, name):
+        if self.zip:
+            return self.zip.read(name)
+        return self.tar.extractfile(name).read()
+    def diagrams(self):
+        return list(self.files)
+    def read(self, diagram):
+        '''Return a dict of name -> bytes for the files of diagram,
+        checking each against its manifest hash.'''
+        out = {}
+        for e in self.files[diagram]:
+            data = self._member(e['name'])
+            if hashlib.sha256(data).hexdigest() != e['sha256']:
+                raise ValueError(f"{e['name']} doesn't match its manifest hash")
+            out[e['name']] = data
+        return out
+    def extract(self, diagram, dir='.'):
+        '''Write the files of diagram into directory dir, which is made
+        if need be; return their paths.'''
+        os.makedirs(dir, exist_ok=True)
+        paths = []
+        for name, data in self.read(diagram).items():
+            paths.append(os.path.join(dir, name))
+            with open(paths[-1], 'wb') as f:
+                f.write(data)
+        return paths
+    def close(self):
+        (self.zip or self.tar).close()
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        self.close()
+
+def read_manifest(path):
+    '''Return the manifest of path: an archive, a directory that a shard
+    run wrote files to, or a manifest file itself.'''
+    if os.path.isdir(path):
+        path = os.path.join(path, MANIFEST)
+    if path.endswith('.json'):
+        with open(path) as f:
+            return json.load(f)
+    with Bundle(path) as b:
+        return b.manifest
+
+def merge_shards(paths, names=None, out=MANIFEST):
+    '''Combine the manifests of archives paths (or output directories,
+    or their manifests: see read_manifest()), written by runs with
+    the shard option (eg, on different machines), into one, written as
+    JSON to file out: it lists each archive with its shard and totals,
+    and each file with the archive holding it.  Print a line for each
+    archive, and totals; return a list of problems found: archives with
+    no shard or a different number of shards, shards missing or given
+    twice, and, if names (of the input file's sections) is given,
+    sections in none of the archives, or in more than one.'''
+    merged, problems, where = {'format': 1, 'shards': [], 'files': []}, [], {}
+    for path in paths:
+        manifest = read_manifest(path)
+        shard, files = manifest.get('shard'), manifest['files']
+        diagrams = {e['diagram'] for e in files}
+        for diagram in diagrams:
+            where.setdefault(diagram, []).append(path)
+        entry = {'archive': path, 'shard': shard, 'diagrams': len(diagrams),
+                 'files': len(files), 'size': sum(e['size'] for e in files)}
+        merged['shards'].append(entry)
+        merged['files'] += [dict(e, archive=path) for e in files]
+        print(f"{path}: shard {shard or '-'}, {entry['diagrams']} diagrams, "
+              f"{entry['files']} files, {entry['size']} bytes")
+    print(f"Total: {len(where)} diagrams, {len(merged['files'])} files, "
+          f"{sum(e['size'] for e in merged['shards'])} bytes")
+    shards = [e['shard'] for e in merged['shards']]
+    problems += [f'{path} has no shard' for path, shard in zip(paths, shards) if not shard]
+    counts = {shard.split('/')[1] for shard in shards if shard}
+    if len(counts) > 1:
+        problems.append(f"Archives are from different numbers of shards: {', '.join(sorted(counts))}")
+    elif counts:
+        n = int(counts.pop())
+        problems += [f'Shard {i}/{n} is missing' for i in range(1, n+1) if shards.count(f'{i}/{n}') == 0]
+        problems += [f'Shard {i}/{n} is given twice' for i in range(1, n+1) if shards.count(f'{i}/{n}') > 1]
+    if names is not None:
+        missing = [name for name in names if name not in where]
+        if missing:
+            problems.append(f"Sections in no archive: {', '.join(missing)}")
+    repeated = [diagram for diagram, paths in where.items() if len(paths) > 1]
+    if repeated:
+        problems.append(f"Diagrams in more than one archive: {', '.join(repeated)}")
+    write_atomic(out, json.dumps(merged, indent=1).encode())
+    return problems
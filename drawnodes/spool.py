@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# -*- mode: python -*-
+
+# Work queue in a spool directory, for the main()s of drawNodes,
+# drawNodesLabeled and drawProgression.  enqueue() puts the sections of
+# an input file in the spool; any number of workers, on one machine or
+# on several sharing the directory, then take sections from it, largest
+# first, one at a time each, until all are done.  So the work balances
+# itself however uneven the sections are, with nothing more than a
+# filesystem to coordinate.  A spool directory holds:
+#
+#   queue/NAME.sec  a section, with the input file's global directives
+#   claims/NAME     a worker's lease on a section, while it works on it
+#   done/NAME       a record of a section's outcome, as JSON
+#   out/            the output files
+#
+# (NAME is the section's name, %-quoted.)  A worker claims a section by
+# creating its claims file, which only one can do, and renews the lease
+# by touching the file while it works.  If a worker dies, its lease
+# expires, after LEASE seconds without renewal, and another worker
+# takes the section over.
+
+import json, os, socket, sys, threading, time, traceback
+from urllib.parse import quote, unquote
+try:
+    from .sections import DIRECTIVES, load_index, read_sections, selected
+    from .sinks import FileSink, write_atomic
+except ImportError:             # Run as a script rather than from the package
+    from sections import DIRECTIVES, load_index, read_sections, selected
+    from sinks import FileSink, write_atomic
+
+LEASE = 60                      # Seconds a claim lasts without renewal
+
+def enqueue(spool, path, only=None, shard=None):
+    '''Put the sections of input file path (just those named by only,
+    and in shard, as for sections.input_sections()) in directory spool,
+    each with the file's global directives; return how many.  Of
+    sections with the same name, the last is put, as its files would
+    replace the others'.  A section put again is redone, even if done.'''
+    if path == '-':
+        raise ValueError('Sections to enqueue must come from a file, not stdin')
+    for sub in ('queue', 'claims', 'done', 'out'):
+        os.makedirs(os.path.join(spool, sub), exist_ok=True)
+    index, last = load_index(path), {}
+    for name, start, end, digest in selected(index, only, shard):
+        last[name] = start, end
+    with open(path, 'rb') as f:
+        prefix = f.read(index['prefix'])
+        for name, (start, end) in last.items():
+            f.seek(start)
+            item = quote(name, safe='')
+            write_atomic(os.path.join(spool, 'queue', item + '.sec'), prefix + f.read(end - start))
+            try:
+                os.unlink(os.path.join(spool, 'done', item))
+            except FileNotFoundError:
+                pass
+    return len(last)
+
+def work(spool, do, options, stable=False, lease=LEASE,
+         directives=tuple(DIRECTIVES), use_globals=True):
+    '''As a worker, call do(sec, options, sink) for each section claimed
+    from directory spool, with sink a FileSink (stable as given) on
+    spool's out directory, until every section there is done; while
+    the rest are claimed by other workers, wait, in case their leases
+    expire.  Return a list of the names of the sections for which do
+    raised an exception, or a render failed; each such exception is
+    reported on stderr.
+    directives and use_globals are as for sections.read_sections().'''
+    worker, failed, sizes = f'{socket.gethostname()}:{os.getpid()}', [], {}
+    sink = FileSink(os.path.join(spool, 'out'), stable)
+    while True:
+        todo = _todo(spool, sizes)
+        if not todo:
+            break
+        item = next((item for item in todo if _claim(spool, item, worker, lease)), None)
+        if item is None:        # All claimed by others, for now
+            time.sleep(min(1, lease / 4))
+            continue
+        with _Renewing(os.path.join(spool, 'claims', item), lease, worker):
+            if os.path.exists(os.path.join(spool, 'done', item)):
+                continue        # Done meanwhile, by a worker whose lease had expired
+            t, ok = time.monotonic(), True
+            with open(os.path.join(spool, 'queue', item + '.sec')) as fin:
+                for sec in read_sections(fin, directives, use_globals):
+                    renders = len(sink.failed)
+                    try:
+                        do(sec, options, sink)
+                    except Exception:
+                        ok = False
+                        sys.stdout.flush()
+                        print(f'Error in section {sec.name}:\n{traceback.format_exc()}',
+                              end='', file=sys.stderr)
+                        failed.append(sec.name)
+                        continue
+                    if len(sink.failed) > renders:      # A render failed, and said why
+                        ok = False
+                        failed.append(sec.name)
+                    else:
+                        sink.finish(sec, options)
+            record = {'name': unquote(item), 'ok': ok, 'worker': worker,
+                      'seconds': round(time.monotonic() - t, 3), 'time': int(time.time())}
+            write_atomic(os.path.join(spool, 'done', item), json.dumps(record).encode())
+    sink.close()
+    return failed
+
+def _todo(spool, sizes):
+    # Sections in spool not yet done, largest first.  Each pass lists
+    # the queue and done directories once, and looks up the size of a
+    # section only the first time it's seen (kept in dict sizes), so
+    # the metadata calls stay few on a network filesystem
+    done, todo = set(os.listdir(os.path.join(spool, 'done'))), []
+    for file in os.listdir(os.path.join(spool, 'queue')):
+        item = file[:-4]
+        if file.startswith('.') or not file.endswith('.sec') or item in done:
+            continue            # A temporary file, or done
+        if item not in sizes:
+            sizes[item] = os.path.getsize(os.path.join(spool, 'queue', file))
+        todo.append((sizes[item], item))
+    return [item for size, item in sorted(todo, reverse=True)]
+
+def _claim(spool, item, worker, lease):
+    # Claim section item for worker, taking over an expired claim; True
+    # if claimed.  Creating the claims file fails if it exists, so just
+    # one worker gets a section; taking one over, just one worker can
+    # move the expired file aside.  (Rarely, a worker that found a claim
+    # expired moves aside the claim another worker has just made on
+    # taking it over; then both work on the section, and write the same
+    # files.)
+    path = os.path.join(spool, 'claims', item)
+    for attempt in range(2):
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        except FileExistsError:
+            try:
+                if attempt or time.time() - os.stat(path).st_mtime < lease:
+                    return False
+                aside = f'{path}.{worker}.expired'
+                os.rename(path, aside)
+                os.unlink(aside)
+            except OSError:
+                return False    # Gone, or moved aside by another worker
+            continue
+        with os.fdopen(fd, 'w') as f:
+            f.write(worker + '\n')
+        return True
+    return False
+
+class _Renewing:
+    # Context holding worker's claim, file path: a thread touches it
+    # every third of a lease, so it doesn't expire; on exit it is
+    # removed, unless another worker has taken it over
+    def __init__(self, path, lease, worker):
+        self.path, self.lease, self.worker = path, lease, worker
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._renew, daemon=True)
+    def _renew(self):
+        while not self.stop.wait(self.lease / 3):
+            try:
+                os.utime(self.path)
+            except OSError:
+                pass            # Taken over; the work goes on regardless
+    def __enter__(self):
+        self.thread.start()
+        return self
+    def __exit__(self, *exc):
+        self.stop.set()
+        self.thread.join()
+        try:
+            with open(self.path) as f:
+                if f.read().strip() == self.worker:
+                    os.unlink(self.path)
+        except OSError:
+            pass
@@ -0,0 +1,92 @@
+# Seeded fuzz tests of grid.py: IncrementalParser.update() must give
+# the same Grid parse() does, and the 'numpy' and 'python' engines must
+# give the same Grids.
+
+import random
+from pathlib import Path
+
+import pytest
+
+from drawnodes.grid import parse, IncrementalParser
+
+STYLES = ('nodes', 'labeled', 'progression')
+VALIDATION = Path(__file__).resolve().parent.parent / 'validation'
+EDIT_CHARS = '_/\\| #Xab'
+
+def _sections():
+    # Lines of each section of the validation sets, less @ directives
+    secs = []
+    for path in sorted(VALIDATION.glob('*/*.txt')):
+        cur = None
+        for l in path.read_text().splitlines():
+            l = l.rstrip()
+            if cur is None:
+                if l.startswith('='): cur = []
+            elif l == '=':
+                secs.append(cur)
+                cur = None
+            elif not l.startswith('@'):
+                cur.append(l)
+    return secs
+SECTIONS = _sections()
+
+def _random_grid(rng):
+    # A validation section with a few cells changed, or random drawing
+    if rng.random() < 0.6:
+        g = [list(l) for l in rng.choice(SECTIONS)]
+        for _ in range(rng.randint(0, 6)):
+            r = rng.randrange(len(g))
+            if g[r]:
+                g[r][rng.randrange(len(g[r]))] = rng.choice(EDIT_CHARS)
+        return [''.join(l).rstrip() for l in g]
+    h, w = rng.randint(1, 12), rng.randint(1, 30)
+    alpha = rng.choice(['_/\\| #X', '_/\\|  #', '_/\\| ', '_/\\| abcx+=-', '_/\\| ##X'])
+    return [''.join(rng.choice(alpha) for _ in range(rng.randint(0, w))).rstrip() for _ in range(h)]
+
+def _edit(rng, lines):
+    # lines with a few cells of one to three lines changed, as in an editor
+    lines = lines[:]
+    for _ in range(rng.choice((1, 1, 1, 2, 3))):
+        r = rng.randrange(len(lines))
+        l = list(lines[r].ljust(rng.randrange(len(lines[r]) + 1, len(lines[r]) + 6)))
+        for _ in range(rng.randrange(1, 4)):
+            l[rng.randrange(len(l))] = rng.choice(EDIT_CHARS)
+        lines[r] = ''.join(l).rstrip()
+    return lines
+
+def _key(j): return (j.num, j.row, j.col, j.code)
+
+def _snapshot(g):
+    # Everything in Grid g, with junctions by position rather than identity
+    return dict(corners=[_key(j) + (tuple(map(_key, j.conn)),) for j in g.corners],
+                nodes=[_key(j) for j in g.nodes],
+                nodetab=[(n.row, n.col, n.xfar, _key(n.hm)) for n in g.nodetab],
+                xlist=[_key(j) for j in g.xlist], owner={k: _key(v) for k, v in g.owner.items()},
+                labels=g.labels, chars=g.chars, text_chars=g.text_chars, bbox=g.bbox, maxy=g.maxy)
+
+@pytest.mark.parametrize('style', STYLES)
+def test_incremental_update_matches_parse(style):
+    rng, incremental = random.Random(f'incremental {style}'), 0
+    for trial in range(400):
+        lines = _random_grid(rng)
+        parser = IncrementalParser(style, 'python')
+        parser.update(lines)
+        for step in range(8):
+            lines = _edit(rng, lines)
+            before = parser.grid
+            g = parser.update(lines)
+            incremental += g is before
+            assert _snapshot(g) == _snapshot(parse(lines, style, 'python')), \
+                f'trial {trial}, edit {step}:\n' + '\n'.join(lines)
+    assert incremental > 1000   # Most edits were applied in place, not reparsed
+
+@pytest.mark.parametrize('style', STYLES)
+def test_engines_agree(style):
+    pytest.importorskip('numpy')
+    rng = random.Random(f'engines {style}')
+    for trial in range(1500):
+        lines = _random_grid(rng)
+        if rng.random() < 0.2:
+            lines = [l + 'é' * rng.randint(0, 1) for l in lines]    # Non-ASCII text
+        assert _snapshot(parse(lines, style, 'python')) == _snapshot(parse(lines, style, 'numpy')), \
+            f'trial {trial}:\n' + '\n'.join(lines)
@@ -0,0 +1,51 @@
+# The journal and resume=: a resumed run skips the sections an earlier
+# run finished, unless their text, options or output files have changed
+# since; a journal cut short by a crash still reads and appends.
+
+import json, os, subprocess, sys
+from pathlib import Path
+
+from drawnodes.sinks import JOURNAL_FILE, Journal
+
+ROOT = Path(__file__).resolve().parent.parent
+INPUT = ROOT / 'validation' / 'draw_nodes' / 'basic_test_set.txt'
+NAMES = ['231', '232', '233small', '234etc', '235small', '236long']
+
+def _run(cwd, *args):
+    # Skipped section names of a draw_nodes run of INPUT in cwd
+    env = dict(os.environ, PYTHONPATH=str(ROOT))
+    out = subprocess.run([sys.executable, '-m', 'drawnodes.draw_nodes', str(INPUT), *args],
+                         cwd=cwd, env=env, check=True, capture_output=True, text=True).stdout
+    return [l.split()[0] for l in out.splitlines() if l.endswith('finished already; skipping it')]
+
+def test_resume_skips_finished_sections(tmp_path):
+    assert _run(tmp_path, 'journal=1') == []
+    times = {n: os.stat(tmp_path / f'{n}.scad').st_mtime_ns for n in NAMES}
+    assert _run(tmp_path, 'resume=1') == NAMES
+    assert times == {n: os.stat(tmp_path / f'{n}.scad').st_mtime_ns for n in NAMES}
+    assert _run(tmp_path, 'resume=1', 'node=00FF0020') == []     # Other options
+
+def test_resume_redoes_changed_outputs(tmp_path):
+    _run(tmp_path, 'journal=1')
+    scad = tmp_path / '232.scad'
+    want = scad.read_text().splitlines()[1:]
+    scad.write_text('// edited\n')
+    assert _run(tmp_path, 'resume=1') == [n for n in NAMES if n != '232']
+    assert scad.read_text().splitlines()[1:] == want
+    assert _run(tmp_path, 'resume=1') == NAMES
+
+def test_plain_run_writes_no_journal(tmp_path):
+    _run(tmp_path)
+    assert (tmp_path / '231.scad').exists()
+    assert not (tmp_path / JOURNAL_FILE).exists()
+
+def test_torn_last_line(tmp_path):
+    (tmp_path / 'a.scad').write_text('cube(1);\n')
+    (tmp_path / JOURNAL_FILE).write_text('{"name": "b", "input": "1", "opt')   # A crash
+    Journal(str(tmp_path)).record('a', ['in', 'opts'], ['a.scad'])
+    lines = (tmp_path / JOURNAL_FILE).read_text().splitlines()
+    assert len(lines) == 2 and json.loads(lines[1])['name'] == 'a'
+    journal = Journal(str(tmp_path))
+    assert journal.finished('a', ['in', 'opts'])
+    assert not journal.finished('b', ['1', ''])
+    assert not journal.finished('a', ['in', 'other opts'])
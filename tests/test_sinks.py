@@ -0,0 +1,42 @@
+# Archive sinks and Bundle: what goes into a tar or zip archive comes
+# back out, and open_sink() refuses out names it doesn't know.
+
+import tarfile
+
+import pytest
+
+from drawnodes.sinks import Bundle, MANIFEST, TarSink, ZipSink, open_sink
+
+FILES = {'fig1.scad': 'cube(1);\n', 'fig1.png': 'not really a PNG', 'fig2.scad': 'sphere(2);\n'}
+
+def _write(sink):
+    for name, text in FILES.items():
+        with sink.open(name) as f:
+            f.write(text)
+    sink.close()
+
+@pytest.mark.parametrize('kind', [TarSink, ZipSink])
+def test_archive_round_trip(kind, tmp_path):
+    path = tmp_path / ('bundle.tar' if kind is TarSink else 'bundle.zip')
+    _write(kind(open(path, 'wb'), True, stable=True, shard=(2, 3)))
+    with Bundle(str(path)) as b:
+        assert sorted(b.diagrams()) == ['fig1', 'fig2']
+        assert b.manifest['shard'] == '2/3'
+        assert b.read('fig1') == {n: FILES[n].encode() for n in ('fig1.scad', 'fig1.png')}
+        paths = b.extract('fig2', str(tmp_path / 'new' / 'figs'))    # Made as needed
+    assert [open(p).read() for p in paths] == [FILES['fig2.scad']]
+
+def test_stable_archives_are_identical(tmp_path):
+    for name in ('a.zip', 'b.zip'):
+        _write(ZipSink(open(tmp_path / name, 'wb'), True, stable=True))
+    assert (tmp_path / 'a.zip').read_bytes() == (tmp_path / 'b.zip').read_bytes()
+
+def test_manifest_is_last_tar_member(tmp_path):
+    _write(TarSink(open(tmp_path / 'b.tar', 'wb'), True))
+    with tarfile.open(tmp_path / 'b.tar') as t:
+        assert t.getnames() == list(FILES) + [MANIFEST]
+
+@pytest.mark.parametrize('out', ['bundle.tgz', 'build/', 'x.json'])
+def test_open_sink_refuses_unknown_out(out):
+    with pytest.raises(ValueError, match='out should be'):
+        open_sink(out)
@@ -0,0 +1,78 @@
+# spool.py: workers share a spool's sections, each done once; an
+# expired claim is taken over; enqueueing a section again has it redone.
+
+import json, os, threading, time
+
+from drawnodes.spool import enqueue, work
+
+def _input(tmp_path, names):
+    path = tmp_path / 'input.txt'
+    path.write_text('@colors=Red\n' + ''.join(f'={n}\n #\n{" " * i}|\n=\n' for i, n in enumerate(names)))
+    return str(path)
+
+def _do(calls):
+    # A do() for work(): note the section, and write a file for it
+    def do(sec, options, sink):
+        calls.append(sec.name)
+        sink.add(sec.name + '.txt', sec.name.encode())
+    return do
+
+def _done(spool):
+    return {f: json.loads(open(os.path.join(spool, 'done', f)).read())
+            for f in os.listdir(os.path.join(spool, 'done'))}
+
+def test_two_workers_do_each_section_once(tmp_path):
+    spool, names = str(tmp_path / 'spool'), [f's{i}' for i in range(12)]
+    assert enqueue(spool, _input(tmp_path, names)) == 12
+    calls = []
+    workers = [threading.Thread(target=work, args=(spool, _do(calls), {})) for _ in range(2)]
+    for w in workers: w.start()
+    for w in workers: w.join()
+    assert sorted(calls) == sorted(names)
+    assert sorted(os.listdir(os.path.join(spool, 'out'))) == sorted(n + '.txt' for n in names)
+    assert all(record['ok'] for record in _done(spool).values())
+    assert os.listdir(os.path.join(spool, 'claims')) == []
+
+def test_expired_claim_is_taken_over(tmp_path):
+    spool = str(tmp_path / 'spool')
+    enqueue(spool, _input(tmp_path, ['a', 'b']))
+    claim = os.path.join(spool, 'claims', 'a')
+    with open(claim, 'w') as f:
+        f.write('elsewhere:1\n')        # A worker that died
+    os.utime(claim, (time.time() - 10, time.time() - 10))
+    calls = []
+    assert work(spool, _do(calls), {}, lease=1) == []
+    assert sorted(calls) == ['a', 'b']
+    assert not os.path.exists(claim)
+
+def test_live_claim_is_waited_for(tmp_path):
+    spool = str(tmp_path / 'spool')
+    enqueue(spool, _input(tmp_path, ['a']))
+    with open(os.path.join(spool, 'claims', 'a'), 'w') as f:
+        f.write('elsewhere:1\n')        # Just claimed, and not renewed
+    calls, t = [], time.monotonic()
+    work(spool, _do(calls), {}, lease=0.6)
+    assert calls == ['a'] and time.monotonic() - t >= 0.5    # Only once it expired
+
+def test_enqueue_again_clears_done(tmp_path):
+    spool = str(tmp_path / 'spool')
+    path = _input(tmp_path, ['a', 'b'])
+    enqueue(spool, path)
+    calls = []
+    work(spool, _do(calls), {})
+    work(spool, _do(calls), {})         # All done: nothing to do
+    assert sorted(calls) == ['a', 'b']
+    enqueue(spool, path, only='b')
+    assert sorted(_done(spool)) == ['a']
+    work(spool, _do(calls), {})
+    assert sorted(calls) == ['a', 'b', 'b']
+
+def test_failed_section_is_recorded(tmp_path):
+    spool = str(tmp_path / 'spool')
+    enqueue(spool, _input(tmp_path, ['good', 'bad']))
+    def do(sec, options, sink):
+        if sec.name == 'bad':
+            raise RuntimeError('broken')
+    assert work(spool, do, {}) == ['bad']
+    done = _done(spool)
+    assert done['good']['ok'] and not done['bad']['ok']
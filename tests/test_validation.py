@@ -0,0 +1,27 @@
+# Golden test: each program's .scad output for its validation set must
+# match tests/golden (made with stable=1), apart from the first line,
+# which holds the time of the run.
+
+import os, subprocess, sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+GOLDEN = Path(__file__).resolve().parent / 'golden'
+SETS = {
+    'draw_nodes':         'validation/draw_nodes/basic_test_set.txt',
+    'draw_nodes_labeled': 'validation/draw_nodes_labeled/labeled_test_set.txt',
+    'draw_progression':   'validation/draw_progression/progression.txt',
+}
+
+@pytest.mark.parametrize('program', sorted(SETS))
+def test_validation_output(program, tmp_path):
+    env = dict(os.environ, PYTHONPATH=str(ROOT))
+    subprocess.run([sys.executable, '-m', f'drawnodes.{program}', str(ROOT / SETS[program])],
+                   cwd=tmp_path, env=env, check=True, capture_output=True)
+    want = sorted(p.name for p in (GOLDEN / program).glob('*.scad'))
+    assert sorted(p.name for p in tmp_path.glob('*.scad')) == want
+    for name in want:
+        got = (tmp_path / name).read_text().splitlines()[1:]
+        assert got == (GOLDEN / program / name).read_text().splitlines()[1:], name